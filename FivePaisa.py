@@ -1,170 +1,306 @@
-import csv
+from __future__ import annotations
+
+import atexit
+import json
+import logging
+import os
+import re
+import shelve
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from functools import lru_cache
 from pathlib import Path
+from typing import TYPE_CHECKING, NamedTuple
+
+if TYPE_CHECKING:
+    from XTS.Connect import XTSConnect
 
-from XTS.Connect import XTSConnect
+log = logging.getLogger(__name__)
 
 
 CSV_FILENAME = "FivePaisaCredentials.csv"
+ORDER_LOG = "Orderlog.txt"
+SESSION_FILE = ".xts_session.json"
+SESSION_MAX_AGE = 6 * 3600  # seconds a cached XTS login is trusted before logging in again
+SYMBOL_CACHE_FILE = ".sym_cache.db"
+
+# Zerodha weekly option symbol: UNDERLYING + YY + month letter + DD + STRIKE + CE/PE
+_OPT_RE = re.compile(r'^([A-Z]+)(\d{2})([A-Z])(\d{2})(\d+)(CE|PE)$')
+
+# Month letter -> month short, as a table indexed by ord(letter) - ord('A')
+_MON_CODES: dict[str, str] = {
+    'J': 'Jan', 'F': 'Feb', 'M': 'Mar', 'A': 'Apr', 'Y': 'May', 'H': 'Jun',
+    'G': 'Jul', 'U': 'Aug', 'S': 'Sep', 'O': 'Oct', 'N': 'Nov', 'D': 'Dec'
+}
+_MON_BY_LETTER: tuple[str | None, ...] = tuple(_MON_CODES.get(chr(65 + i)) for i in range(26))
+
+# Two-digit year -> four-digit year string ("25" -> "2025")
+_YEAR_STR: tuple[str, ...] = tuple(f"20{i:02d}" for i in range(100))
+
+_IDX_SYMBOLS: frozenset[str] = frozenset(sys.intern(s) for s in ("NIFTY", "BANKNIFTY", "FINNIFTY", "MIDCPNIFTY"))
+
+
+class ParsedOption(NamedTuple):
+    symbol: str
+    expiry_api_format: str
+    option_type: str
+    strike: int
+    series: str
 
 
-def parse_zerodha_option_symbol(sym: str) -> dict:
+@lru_cache(maxsize=4096)
+def parse_zerodha_option_symbol(sym: str) -> ParsedOption:
     # Example: NIFTY25N0425800PE -> symbol=NIFTY, yy=25, mon_code=N, dd=04, strike=25800, type=PE
-    # Build components
-    i = 0
-    while i < len(sym) and sym[i].isalpha():
-        i += 1
-    underlying = sym[:i]
-    rest = sym[i:]
-    # Year (2), month letter (1), day (2)
-    yy = rest[:2]
-    mon_code = rest[2]
-    dd = rest[3:5]
-    tail = rest[5:]
-    # Strike (digits before CE/PE), type (CE/PE)
-    opt_type = "PE" if tail.endswith("PE") else "CE"
-    strike_str = tail[:-2]
+    m = _OPT_RE.match(sym)
+    if not m:
+        raise ValueError(f"Unrecognised option symbol: {sym}")
+    underlying, yy, mon_code, dd, strike_str, opt_type = m.groups()
+    # Interned so the index-set lookup below hits the identity fast path
+    underlying = sys.intern(underlying)
     strike = int(strike_str)
-    # Month letter -> month short
-    mon_map = {
-        'J': 'Jan', 'F': 'Feb', 'M': 'Mar', 'A': 'Apr', 'Y': 'May', 'H': 'Jun',
-        'G': 'Jul', 'U': 'Aug', 'S': 'Sep', 'O': 'Oct', 'N': 'Nov', 'D': 'Dec'
-    }
-    if mon_code not in mon_map:
+    mon = _MON_BY_LETTER[ord(mon_code) - 65]
+    if mon is None:
         raise ValueError(f"Unknown month code: {mon_code} in {sym}")
-    mon = mon_map[mon_code]
-    yyyy = f"20{yy}"
-    expiry_api_format = f"{dd}{mon}{yyyy}"
+    yyyy = _YEAR_STR[int(yy)]
+    expiry_api_format = dd + mon + yyyy
     # Series
-    idx_symbols = {"NIFTY", "BANKNIFTY", "FINNIFTY", "MIDCPNIFTY"}
-    series = "OPTIDX" if underlying in idx_symbols else "OPTSTK"
-    return {
-        "symbol": underlying,
-        "expiry_api_format": expiry_api_format,
-        "option_type": opt_type,
-        "strike": strike,
-        "series": series,
-    }
-
-def read_credentials(csv_path: Path) -> dict:
-    creds = {}
-    if not csv_path.exists():
-        return creds
-    with csv_path.open(newline="", encoding="utf-8") as f:
-        reader = csv.reader(f)
-        for row in reader:
-            if not row or len(row) < 2:
-                continue
-            k = (row[0] or "").strip().lower()
-            v = (row[1] or "").strip()
-            if k:
-                creds[k] = v
-    return creds
-
-
-def first(creds: dict, *keys: str) -> str | None:
-    for k in keys:
-        v = creds.get(k)
-        if v:
-            return v
-    return None
+    series = "OPTIDX" if underlying in _IDX_SYMBOLS else "OPTSTK"
+    # Immutable, so the instance shared by every caller through the cache is safe
+    return ParsedOption(underlying, expiry_api_format, opt_type, strike, series)
+
+
+@lru_cache(maxsize=1)
+def _get_log_fd() -> int:
+    # Opened once for the process lifetime; O_APPEND makes each os.write land atomically at EOF
+    flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, "O_BINARY", 0)
+    fd = os.open(str(Path(__file__).parent / ORDER_LOG), flags, 0o644)
+    atexit.register(os.close, fd)
+    return fd
+
+
+def write_log(line: str) -> None:
+    os.write(_get_log_fd(), line.encode("utf-8"))
+
+
+# Canonical credential slot -> accepted CSV key names, in priority order
+_CRED_ALIASES: dict[str, tuple[str, ...]] = {
+    "ikey": ("interactive_api_key", "interactive key", "interactive_key"),
+    "isecret": ("interactive_api_secret", "interactive secret", "interactive_secret"),
+    "mkey": ("market_data_api_key", "market key", "market_api_key"),
+    "msecret": ("market_data_api_secret_key", "market secret", "market_api_secret"),
+    "source": ("source",),
+}
+# CSV key -> (slot, priority)
+_ALIAS_SLOTS: dict[str, tuple[str, int]] = {
+    alias: (slot, rank)
+    for slot, aliases in _CRED_ALIASES.items()
+    for rank, alias in enumerate(aliases)
+}
+
+
+def resolve_credential_slots(creds: dict[str, str]) -> dict[str, str]:
+    """Map raw CSV keys onto canonical slots in a single pass, preferring earlier aliases."""
+    slots: dict[str, str] = {}
+    ranks: dict[str, int] = {}
+    for k, v in creds.items():
+        hit = _ALIAS_SLOTS.get(k)
+        if not hit or not v:
+            continue
+        slot, rank = hit
+        if slot not in ranks or rank < ranks[slot]:
+            slots[slot] = v
+            ranks[slot] = rank
+    return slots
+
+
+def load_xts_session(path: Path) -> dict | None:
+    """Return the cached login responses if they are recent enough to reuse."""
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or time.time() - float(data.get("ts") or 0) >= SESSION_MAX_AGE:
+        return None
+    if not data.get("itoken") or not data.get("mtoken"):
+        return None
+    return data
+
+
+def save_xts_session(path: Path, iresp: dict, mresp: dict) -> None:
+    try:
+        path.write_text(json.dumps({"itoken": iresp, "mtoken": mresp, "ts": time.time()}), encoding="utf-8")
+    except OSError as e:
+        log.warning("Could not cache XTS session: %s", e)
+
+
+def xts_login(xt: XTSConnect, xm: XTSConnect, session_path: Path) -> None:
+    # Interactive login (trading)
+    iresp = xt.interactive_login()
+    log.info("Interactive login response: %s", iresp)
+
+    # Market data login (quotes)
+    mresp = xm.marketdata_login()
+    log.info("Marketdata login response: %s", mresp)
+
+    if isinstance(iresp, dict) and iresp.get("type") == "success" \
+            and isinstance(mresp, dict) and mresp.get("type") == "success":
+        save_xts_session(session_path, iresp, mresp)
+
+
+def resolve_option(xm: XTSConnect, parsed: ParsedOption) -> dict:
+    return xm.get_option_symbol(
+        exchangeSegment=2,
+        series=parsed.series,
+        symbol=parsed.symbol,
+        expiryDate=parsed.expiry_api_format,
+        optionType=parsed.option_type,
+        strikePrice=parsed.strike,
+    )
+
+
+def open_symbol_cache(path: Path) -> shelve.Shelf:
+    """Open the on-disk get_option_symbol cache, dropping entries from earlier trading days."""
+    cache = shelve.open(str(path))
+    today = date.today().isoformat()
+    for key in [k for k, entry in cache.items() if entry.get("d") != today]:
+        del cache[key]
+    return cache
+
+
+def _symbol_cache_key(parsed: ParsedOption) -> str:
+    return f"{parsed.series}|{parsed.symbol}|{parsed.expiry_api_format}|{parsed.option_type}|{parsed.strike}"
+
+
+def resolve_options(xm: XTSConnect, parsed_list: list[ParsedOption], cache: shelve.Shelf | None = None,
+                    max_workers: int = 8) -> list:
+    """Resolve several parsed symbols concurrently; results are returned in input order.
+
+    Each call is a blocking HTTPS request, so threads overlap the network waits. Without a
+    `pool`, XTSConnect issues every request through a fresh `requests` session, which keeps
+    the client safe to share across workers. When `cache` is given, successful responses are
+    stored for the rest of the day and reused without a network call; the shelf is only
+    touched from the calling thread.
+    """
+    today = date.today().isoformat()
+    results: list = [None] * len(parsed_list)
+    misses: list[int] = []
+    for i, parsed in enumerate(parsed_list):
+        entry = cache.get(_symbol_cache_key(parsed)) if cache is not None else None
+        if entry and entry.get("d") == today:
+            results[i] = entry["r"]
+        else:
+            misses.append(i)
+
+    if len(misses) <= 1:
+        fetched = [resolve_option(xm, parsed_list[i]) for i in misses]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(misses))) as ex:
+            fetched = list(ex.map(lambda i: resolve_option(xm, parsed_list[i]), misses))
+
+    for i, resp in zip(misses, fetched):
+        results[i] = resp
+        if cache is not None and isinstance(resp, dict) and resp.get("type") == "success":
+            cache[_symbol_cache_key(parsed_list[i])] = {"d": today, "r": resp}
+    return results
+
+
+def _is_token_error(result: object) -> bool:
+    """True when an XTS call failed because the session token was rejected.
+
+    For "Invalid Token" the SDK raises XTSTokenException, and its wrappers then fail in
+    their own except clause (`return response['description']`), so the caller sees an
+    UnboundLocalError whose __context__ is the token exception. An error response
+    returned without raising is checked by its type/description.
+    """
+    if isinstance(result, dict):
+        return result.get("type") == "error" and "token" in str(result.get("description") or "").lower()
+    if isinstance(result, BaseException):
+        from XTS.Exception import XTSTokenException
+        return isinstance(result, XTSTokenException) or isinstance(result.__context__, XTSTokenException)
+    return False
 
 
 def main() -> None:
-    creds = read_credentials(Path(__file__).parent / CSV_FILENAME)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    # Same "title,value" loader as the Zerodha side; imported here, like XTS below, to keep
+    # the Kite/Selenium stack out of a parser-only import
+    from zerodha_integration import read_csv_kv
+    creds = read_csv_kv(Path(__file__).parent / CSV_FILENAME)
 
     # Read credentials (support multiple key names)
-    interactive_key = first(creds, "interactive_api_key", "interactive key", "interactive_key")
-    interactive_secret = first(creds, "interactive_api_secret", "interactive secret", "interactive_secret")
-    market_key = first(creds, "market_data_api_key", "market key", "market_api_key")
-    market_secret = first(creds, "market_data_api_secret_key", "market secret", "market_api_secret")
-    source = first(creds, "source") or "WEBAPI"
-
-    missing = []
-    if not interactive_key:
-        missing.append("interactive_api_key")
-    if not interactive_secret:
-        missing.append("interactive_api_secret")
-    if not market_key:
-        missing.append("market_data_api_key")
-    if not market_secret:
-        missing.append("market_data_api_secret_key")
+    slots = resolve_credential_slots(creds)
+    interactive_key = slots.get("ikey")
+    interactive_secret = slots.get("isecret")
+    market_key = slots.get("mkey")
+    market_secret = slots.get("msecret")
+    source = slots.get("source") or "WEBAPI"
+
+    required = (
+        ("interactive_api_key", interactive_key),
+        ("interactive_api_secret", interactive_secret),
+        ("market_data_api_key", market_key),
+        ("market_data_api_secret_key", market_secret),
+    )
+    missing = [name for name, value in required if not value]
     if missing:
-        print("Missing required credential(s) in FivePaisaCredentials.csv:")
-        for m in missing:
-            print(f" - {m}")
+        log.error("Missing required credential(s) in FivePaisaCredentials.csv:\n%s",
+                  "\n".join(f" - {m}" for m in missing))
         sys.exit(2)
 
-    # Interactive login (trading)
-    xt = XTSConnect(apiKey=interactive_key, secretKey=interactive_secret, source=source)
-    iresp = xt.interactive_login()
-    print("Interactive login response:", iresp)
+    # Imported here so importing this module for the parser alone skips the HTTP client stack
+    from XTS.Connect import XTSConnect
+    from XTS.Exception import XTSTokenException
 
-    # Market data login (quotes)
+    xt = XTSConnect(apiKey=interactive_key, secretKey=interactive_secret, source=source)
     xm = XTSConnect(apiKey=market_key, secretKey=market_secret, source=source)
-    mresp = xm.marketdata_login()
-    print("Marketdata login response:", mresp)
 
-    # Quick test: resolve a Zerodha-style option symbol to 5paisa instrument using get_option_symbol
-    test_sym = "NIFTY25N0425800PE"  # adjust as needed
+    # Reuse a recent session when one is cached; otherwise log in and cache it
+    session_path = Path(__file__).parent / SESSION_FILE
+    cached = load_xts_session(session_path)
+    if cached:
+        ires, mres = cached["itoken"]["result"], cached["mtoken"]["result"]
+        xt.set_token(ires["token"], ires["userID"], ires.get("isInvestorClient", False))
+        xm.set_token(mres["token"], mres["userID"], False)
+        log.info("Reusing cached XTS session")
+    else:
+        xts_login(xt, xm, session_path)
+
+    # Quick test: resolve Zerodha-style option symbols to 5paisa instruments using get_option_symbol
+    test_syms = ["NIFTY25N0425800PE"]  # adjust as needed
+    resolved_syms = []
+    parsed_list = []
+    for sym in test_syms:
+        try:
+            parsed = parse_zerodha_option_symbol(sym)
+        except ValueError as e:
+            log.error("Symbol parse failed: %s", e)
+            continue
+        log.info("Parsed: %s", parsed)
+        resolved_syms.append(sym)
+        parsed_list.append(parsed)
+
     try:
-        parsed = parse_zerodha_option_symbol(test_sym)
-        print("Parsed:", parsed)
-        resp = xm.get_option_symbol(
-            exchangeSegment=2,
-            series=parsed["series"],
-            symbol=parsed["symbol"],
-            expiryDate=parsed["expiry_api_format"],
-            optionType=parsed["option_type"],
-            strikePrice=parsed["strike"],
-        )
-        print("5paisa get_option_symbol response:", resp)
-        # Log
-        log_path = Path(__file__).parent / "Orderlog.txt"
-        with log_path.open("a", encoding="utf-8") as lf:
-            lf.write(f"RESOLVE {test_sym} -> {resp}\n")
+        with open_symbol_cache(Path(__file__).parent / SYMBOL_CACHE_FILE) as cache:
+            try:
+                results = resolve_options(xm, parsed_list, cache)
+            except (XTSTokenException, UnboundLocalError) as exc:
+                if not (cached and _is_token_error(exc)):
+                    raise
+                results = None
+            if cached and (results is None or any(_is_token_error(r) for r in results)):
+                # Cached token was rejected (expired/invalidated); log in afresh and retry once
+                log.info("Cached XTS session rejected; logging in again")
+                xts_login(xt, xm, session_path)
+                results = resolve_options(xm, parsed_list, cache)
+        for sym, resp in zip(resolved_syms, results):
+            log.info("5paisa get_option_symbol response: %s", resp)
+            # Log
+            write_log(f"RESOLVE {sym} -> {resp}\n")
     except Exception as e:
-        print(f"Symbol resolve failed: {e}")
+        log.error("Symbol resolve failed: %s", e)
 
 
 if __name__ == "__main__":
     main()
-
-def parse_zerodha_option_symbol(sym: str) -> dict:
-    # Example: NIFTY25N0425800PE -> symbol=NIFTY, yy=25, mon_code=N, dd=04, strike=25800, type=PE
-    # Build components
-    # 1) Extract underlying alpha prefix
-    i = 0
-    while i < len(sym) and sym[i].isalpha():
-        i += 1
-    underlying = sym[:i]
-    rest = sym[i:]
-    # 2) Year (2), month letter (1), day (2)
-    yy = rest[:2]
-    mon_code = rest[2]
-    dd = rest[3:5]
-    tail = rest[5:]
-    # 3) Strike (digits before CE/PE), type (CE/PE)
-    opt_type = "PE" if tail.endswith("PE") else "CE"
-    strike_str = tail[:-2]
-    strike = int(strike_str)
-    # Month letter -> month short
-    mon_map = {
-        'N': 'Nov', 'D': 'Dec', 'O': 'Oct', 'S': 'Sep', 'A': 'Apr', 'M': 'Mar',
-        'J': 'Jan', 'F': 'Feb', 'U': 'Aug', 'G': 'Jul', 'H': 'Jun', 'Y': 'May'
-    }
-    if mon_code not in mon_map:
-        raise ValueError(f"Unknown month code: {mon_code} in {sym}")
-    mon = mon_map[mon_code]
-    yyyy = f"20{yy}"
-    expiry_api_format = f"{dd}{mon}{yyyy}"
-    # Series
-    idx_symbols = {"NIFTY", "BANKNIFTY", "FINNIFTY", "MIDCPNIFTY"}
-    series = "OPTIDX" if underlying in idx_symbols else "OPTSTK"
-    return {
-        "symbol": underlying,
-        "expiry_api_format": expiry_api_format,
-        "option_type": opt_type,
-        "strike": strike,
-        "series": series,
-    }
\ No newline at end of file
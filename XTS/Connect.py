@@ -197,6 +197,10 @@ class XTSConnect(XTSCommon):
         """Set the `access_token` received after a successful authentication."""
         super().__init__(access_token,userID, isInvestorClient)
 
+    def set_token(self, token, userID, isInvestorClient=False):
+        """Reuse a token from an earlier login instead of calling the login endpoint again."""
+        self._set_common_variables(token, userID, isInvestorClient)
+
     def _login_url(self):
         """Get the remote login url to which a user should be redirected to initiate the login flow."""
         return self._default_login_uri
@@ -1,523 +1,910 @@
-import csv
+import atexit
 import json
-import math
+import logging
+import os
+import queue
+import re
+import signal
 import sys
+import threading
 import time
-from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import date, datetime, timezone
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
 
-from kiteconnect import KiteConnect
+try:
+    # Optional: much faster parsing of quote payloads and of the mapping/journal files
+    import orjson
 
-from zerodha_integration import login as z_login
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps  # compact, returns bytes
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+try:
+    # Optional: stream the REST orderbook instead of materialising the whole list
+    import ijson
+except ImportError:
+    ijson = None
+
+from kiteconnect import KiteConnect, KiteTicker
+
+from zerodha_integration import atomic_write, http_pool, load_zerodha_creds, read_csv_kv, login as z_login
 from XTS.Connect import XTSConnect
 
+log = logging.getLogger("copy_trader")
+# Pass as `extra=` on records that must reach Orderlog.txt immediately (placements, login failures)
+_FLUSH = {"flush": True}
 
 Z_CRED_CSV = "ZerodhaCredentials.csv"
 FP_CRED_CSV = "FivePaisaCredentials.csv"
-MAPPING_FILE = "copy_map.json"
+MAPPING_FILE = "copy_map.json"  # header: _started, _cursor
+JOURNAL_FILE = "copy_map.jsonl"  # append-only order records, one {zid: record} per line
 ORDER_LOG = "Orderlog.txt"
+EXPIRY_CACHE_TTL = 3600  # seconds a get_expiry_date result is reused
+RECONCILE_INTERVAL = 60  # seconds between REST orderbook reconciliations while the websocket is up
+POLL_INTERVAL = 2  # seconds between REST polls while the websocket is down (starting value)
+POLL_INTERVAL_MIN = 0.25  # fallback polling speeds up to this while fills keep arriving
+POLL_INTERVAL_MAX = 5.0  # ...and backs off to this while the orderbook is idle
+DEBUG = os.environ.get("COPY_TRADER_DEBUG") == "1"  # log raw 5paisa order params/responses
+MAX_WORKERS = 8  # concurrent resolve/place calls when several fills arrive together
+XTS_POOL_SIZE = 16  # keep-alive sockets per XTSConnect client, enough for every worker
+
+# Month name mapping (3-char to short name) - for MONTHLY expiry
+_MONTH_NAME_MAP = {
+    'JAN': 'Jan', 'FEB': 'Feb', 'MAR': 'Mar', 'APR': 'Apr', 'MAY': 'May', 'JUN': 'Jun',
+    'JUL': 'Jul', 'AUG': 'Aug', 'SEP': 'Sep', 'OCT': 'Oct', 'NOV': 'Nov', 'DEC': 'Dec'
+}
+# Single char month code mapping - for WEEKLY expiry
+_MON_MAP = {
+    'J': 'Jan', 'F': 'Feb', 'M': 'Mar', 'A': 'Apr', 'Y': 'May', 'H': 'Jun',
+    'G': 'Jul', 'U': 'Aug', 'S': 'Sep', 'O': 'Oct', 'N': 'Nov', 'D': 'Dec'
+}
+_IDX_SYMBOLS = frozenset({"NIFTY", "BANKNIFTY", "FINNIFTY", "MIDCPNIFTY"})
+# Underlyings whose options trade on BSE F&O; everything else is NSE F&O
+_BSE_UNDERLYINGS = frozenset({"SENSEX", "BANKEX"})
+# Groups: underlying, yy, monthly month name | weekly month letter, weekly day, strike, CE/PE
+_OPT_RE = re.compile(
+    r"^([A-Z]+)(\d{2})(?:(" + "|".join(_MONTH_NAME_MAP) + r")|([A-Z])(\d{2}))(\d+)(CE|PE)$"
+)
+
+# Terminal Zerodha statuses that are never copied
+_SETTLED_STATUSES = frozenset({"REJECTED", "CANCELLED"})
+
+# Session-lifetime caches for 5paisa lookups (option contract -> instrument is stable for the day)
+_INSTR_CACHE: Dict[Tuple[str, str], Dict[str, Any]] = {}  # (exchange, tradingsymbol) -> instrument
+_INSTR_CACHE_DAY: Optional[date] = None
+_EXPIRY_CACHE: Dict[tuple, tuple] = {}  # key -> (fetched_at, expiry_resp)
+
+# Option contracts from the XTS instrument master, downloaded once after login
+_MONTH_ABBR = tuple(_MONTH_NAME_MAP.values())
+_MASTER_SEGMENTS = {"NSEFO": 2, "BSEFO": 12}  # master segment name -> market-data segment id
+_MASTER_OPT_TYPES = {"3": "CE", "4": "PE"}
+# Column positions in the pipe-delimited F&O master rows
+_M_SEG, _M_ID, _M_NAME, _M_TICK, _M_EXPIRY, _M_STRIKE, _M_OPT = 0, 1, 3, 11, 16, 17, 18
+# (segment, symbol, "25Nov2025", CE/PE, strike in paise) -> (ExchangeInstrumentID, TickSize);
+# paise so fractional strikes (7 vs 7.5) stay distinct
+_INSTR_MASTER: Dict[tuple, Tuple[int, float]] = {}
+# (segment, symbol, "Nov2025") -> last expiry of that month, i.e. the monthly contract
+_MASTER_MONTH_EXPIRY: Dict[tuple, str] = {}
+
+
+class BufferedFileHandler(logging.FileHandler):
+    """FileHandler writing through a 64 KiB buffer instead of flushing every record.
+
+    Records logged with `extra=_FLUSH`, or at WARNING and above, flush straight away.
+    """
 
+    def _open(self):
+        return open(self.baseFilename, self.mode, buffering=1 << 16, encoding=self.encoding)
 
-def read_csv_kv(csv_path: Path) -> Dict[str, str]:
-    out: Dict[str, str] = {}
-    if not csv_path.exists():
-        return out
-    with csv_path.open(newline="", encoding="utf-8") as f:
-        for row in csv.reader(f):
-            if not row or len(row) < 2:
-                continue
-            k = (row[0] or "").strip().lower()
-            v = (row[1] or "").strip()
-            if k:
-                out[k] = v
-    return out
+    def emit(self, record: logging.LogRecord) -> None:
+        if self.stream is None:
+            self.stream = self._open()
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+            if getattr(record, "flush", False) or record.levelno >= logging.WARNING:
+                self.flush()
+        except Exception:
+            self.handleError(record)
 
 
-def log_line(msg: str) -> None:
-    ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    line = f"[{ts}] {msg}\n"
-    try:
-        Path(ORDER_LOG).open("a", encoding="utf-8").write(line)
-    except Exception:
-        pass
-    print(line, end="")
+class LineFormatter(logging.Formatter):
+    """`[YYYY-MM-DD HH:MM:SS] message` lines, stamped without a strftime per record."""
 
+    def formatTime(self, record: logging.LogRecord, datefmt: Optional[str] = None) -> str:
+        return datetime.fromtimestamp(record.created).isoformat(sep=" ", timespec="seconds")
 
-def load_mapping(path: Path) -> Dict[str, Any]:
-    if not path.exists():
-        return {"orders": {}}
-    try:
-        return json.loads(path.read_text(encoding="utf-8") or "{}") or {"orders": {}}
-    except Exception:
-        return {"orders": {}}
+
+def load_mapping(path: Path, journal_path: Path) -> Dict[str, Any]:
+    data: Dict[str, Any] = {"orders": {}}
+    if path.exists():
+        try:
+            data = _json_loads(path.read_bytes() or b"{}") or data
+        except Exception:
+            pass
+    data.setdefault("orders", {})
+    # Replay the order journal; later lines win over earlier ones
+    if journal_path.exists():
+        with journal_path.open("rb") as fh:
+            for line in fh:
+                try:
+                    data["orders"].update(_json_loads(line))
+                except ValueError:
+                    # Torn last line from a crash mid-write
+                    continue
+    return data
 
 
 def save_mapping(path: Path, data: Dict[str, Any]) -> None:
-    path.write_text(json.dumps(data, indent=2), encoding="utf-8")
+    """Rewrite the small header file; order records are appended to the journal instead."""
+    header = {k: v for k, v in data.items() if k != "orders"}
+    atomic_write(path, _json_dumps(header))
 
 
-def read_multiplier(z_creds: Dict[str, str]) -> int:
-    # Accept several key variants
-    for key in ["copytradeqtymultiplier", "copy_trade_qty_multiplier", "multiplier"]:
-        if key in z_creds:
-            try:
-                val = int(float(z_creds[key]))
-                return max(1, val)
-            except Exception:
-                continue
+def _journal_lines(records: Dict[str, Any]) -> bytes:
+    return b"".join(_json_dumps({zid: rec}) + b"\n" for zid, rec in records.items())
+
+
+# O_DSYNC is POSIX-only; without it (Windows) the journal fsyncs after each write instead
+_O_DSYNC = getattr(os, "O_DSYNC", 0)
+
+
+class OrderJournal:
+    """Append-only order journal on a raw O_APPEND|O_DSYNC descriptor.
+
+    write() only queues encoded lines; flush() hands it to the OS in one os.write, which is
+    on stable storage by the time it returns.
+    """
+
+    def __init__(self, path: Path) -> None:
+        flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT | _O_DSYNC | getattr(os, "O_BINARY", 0)
+        self._fd = os.open(str(path), flags, 0o600)
+        self._pending: List[bytes] = []
+
+    def write(self, data: bytes) -> None:
+        self._pending.append(data)
+
+    def flush(self) -> None:
+        if not self._pending:
+            return
+        data = memoryview(b"".join(self._pending))
+        self._pending.clear()
+        while data:
+            data = data[os.write(self._fd, data):]
+        if not _O_DSYNC:
+            os.fsync(self._fd)
+
+    def close(self) -> None:
+        self.flush()
+        os.close(self._fd)
+
+
+def append_orders(journal: OrderJournal, records: Dict[str, Any]) -> None:
+    """Append order records to the open journal in a single write."""
+    if records:
+        journal.write(_journal_lines(records))
+
+
+def compact_journal(journal_path: Path, orders: Dict[str, Any]) -> None:
+    """Rewrite the journal with exactly one line per order."""
+    atomic_write(journal_path, _journal_lines(orders))
+
+
+def _resp_field(resp: Any, key: str) -> Any:
+    """resp[key] for an XTS response dict; the SDK sometimes returns a bare string instead."""
+    return resp.get(key) if isinstance(resp, dict) else None
+
+
+def read_multiplier(value: Optional[str]) -> int:
+    if value:
+        try:
+            return max(1, int(float(value)))
+        except ValueError:
+            pass
     return 1
 
 
+def load_instrument_master(xm: XTSConnect) -> int:
+    """Index every NSEFO/BSEFO option contract from the XTS master; returns the count."""
+    try:
+        resp = xm.get_master(exchangeSegmentList=list(_MASTER_SEGMENTS))
+    except Exception as e:
+        resp = e
+    if not isinstance(resp, dict) or resp.get("type") != "success" or not isinstance(resp.get("result"), str):
+        log.info(f"Instrument master download failed; resolving over REST instead: {resp}")
+        return 0
+    month_last: Dict[tuple, datetime] = {}
+    for line in resp["result"].splitlines():
+        f = line.split("|")
+        if len(f) <= _M_OPT:
+            continue
+        seg = _MASTER_SEGMENTS.get(f[_M_SEG])
+        opt_type = _MASTER_OPT_TYPES.get(f[_M_OPT])
+        if seg is None or opt_type is None:
+            continue
+        try:
+            exp = datetime.fromisoformat(f[_M_EXPIRY])
+            key = (seg, f[_M_NAME], f"{exp.day:02d}{_MONTH_ABBR[exp.month - 1]}{exp.year}",
+                   opt_type, round(float(f[_M_STRIKE]) * 100))
+            _INSTR_MASTER[key] = (int(f[_M_ID]), float(f[_M_TICK]))
+        except ValueError:
+            continue
+        month_key = (seg, f[_M_NAME], key[2][2:])
+        if month_key not in month_last or exp > month_last[month_key]:
+            month_last[month_key] = exp
+    for month_key, exp in month_last.items():
+        _MASTER_MONTH_EXPIRY[month_key] = f"{exp.day:02d}{_MONTH_ABBR[exp.month - 1]}{exp.year}"
+    return len(_INSTR_MASTER)
+
+
 def resolve_5p_instrument(xm: XTSConnect, exch: str, tradingsymbol: str) -> Optional[Dict[str, Any]]:
     # Very basic resolver: handle index options like NIFTY25N0425800PE via get_option_symbol
+    global _INSTR_CACHE_DAY
+    # Repeat fills in a contract skip parsing and logging entirely; reset when the trading day rolls
+    today = date.today()
+    if today != _INSTR_CACHE_DAY:
+        _INSTR_CACHE.clear()
+        _INSTR_CACHE_DAY = today
+    instr_key = (exch, tradingsymbol)
+    cached = _INSTR_CACHE.get(instr_key)
+    if cached is not None:
+        return cached
     try:
         # Try parse as option
         parsed = parse_zerodha_option_symbol(tradingsymbol)
-        log_line(f"Parsed {tradingsymbol}: symbol={parsed['symbol']}, expiry={parsed['expiry_api_format']}, strike={parsed['strike']}, type={parsed['option_type']}, is_monthly={parsed.get('is_monthly_expiry', False)}")
+        log.info(f"Parsed {tradingsymbol}: symbol={parsed.symbol}, expiry={parsed.expiry_api_format}, strike={parsed.strike}, type={parsed.option_type}, is_monthly={parsed.is_monthly_expiry}")
         
         # Determine exchange segment for get_option_symbol (numeric)
-        # For SENSEX use 12 (BSEFO), for others use 2 (NSEFO)
+        # For SENSEX/BANKEX use 12 (BSEFO), for others use 2 (NSEFO)
         # Use parsed symbol (e.g., "SENSEX") instead of full tradingsymbol for more reliable detection
-        exchange_segment = get_exchange_segment_numeric_for_marketdata(parsed["symbol"])
-        log_line(f"Using exchangeSegment={exchange_segment} for {tradingsymbol} (symbol={parsed['symbol']})")
-        
+        exchange_segment = get_exchange_segment_numeric_for_marketdata(parsed.symbol)
+        log.info(f"Using exchangeSegment={exchange_segment} for {tradingsymbol} (symbol={parsed.symbol})")
+
+        # Instrument master first; REST only for contracts it does not know
+        if _INSTR_MASTER:
+            expiry = parsed.expiry_api_format
+            if parsed.is_monthly_expiry:
+                expiry = _MASTER_MONTH_EXPIRY.get((exchange_segment, parsed.symbol, expiry[2:]), expiry)
+            hit = _INSTR_MASTER.get((exchange_segment, parsed.symbol, expiry, parsed.option_type,
+                                     round(parsed.strike * 100)))
+            if hit is not None:
+                _INSTR_CACHE[instr_key] = {"ExchangeInstrumentID": hit[0], "TickSize": hit[1]}
+                return _INSTR_CACHE[instr_key]
+            log.info(f"{tradingsymbol} not in instrument master; resolving over REST")
+
         # If monthly expiry, fetch actual expiry date from API
-        expiry_date = parsed["expiry_api_format"]
-        if parsed.get("is_monthly_expiry", False):
+        expiry_date = parsed.expiry_api_format
+        if parsed.is_monthly_expiry:
             # For monthly expiry, get list of expiry dates and find the one matching the month/year
             try:
-                expiry_resp = xm.get_expiry_date(
-                    exchangeSegment=exchange_segment,
-                    series=parsed["series"],
-                    symbol=parsed["symbol"]
-                )
+                expiry_key = (exchange_segment, parsed.series, parsed.symbol)
+                hit = _EXPIRY_CACHE.get(expiry_key)
+                if hit is not None and time.time() - hit[0] < EXPIRY_CACHE_TTL:
+                    expiry_resp = hit[1]
+                else:
+                    expiry_resp = xm.get_expiry_date(
+                        exchangeSegment=exchange_segment,
+                        series=parsed.series,
+                        symbol=parsed.symbol
+                    )
+                    if expiry_resp and expiry_resp.get("result"):
+                        _EXPIRY_CACHE[expiry_key] = (time.time(), expiry_resp)
                 # get_expiry_date returns result directly (not wrapped in type:success)
                 if expiry_resp and expiry_resp.get("result"):
                     expiry_dates = expiry_resp["result"]
-                    month_names = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+                    month_names = _MONTH_ABBR
                     
                     # Extract month and year from parsed expiry (e.g., "01Nov2025" -> Nov 2025)
-                    parsed_dt = datetime.strptime(parsed["expiry_api_format"], "%d%b%Y")
+                    parsed_dt = datetime.strptime(parsed.expiry_api_format, "%d%b%Y")
                     target_month = parsed_dt.month
                     target_year = parsed_dt.year
                     
-                    # Filter expiry dates to match the month and year from symbol
-                    matching_dates = []
+                    # Latest expiry date in the month and year from symbol, in one pass
+                    # (ISO strings compare chronologically, so no sort is needed)
+                    latest_expiry = None
+                    matched = 0
                     for exp_date_str in expiry_dates:
+                        # ISO "2025-11-25T14:30:00": year and month are fixed-position slices
                         try:
-                            dt = datetime.strptime(exp_date_str, "%Y-%m-%dT%H:%M:%S")
-                            if dt.month == target_month and dt.year == target_year:
-                                matching_dates.append(exp_date_str)
+                            if int(exp_date_str[5:7]) == target_month and int(exp_date_str[:4]) == target_year:
+                                matched += 1
+                                if latest_expiry is None or exp_date_str > latest_expiry:
+                                    latest_expiry = exp_date_str
                         except Exception:
                             continue
-                    
-                    if matching_dates:
-                        # Sort matching dates (latest first) and take the latest one
-                        matching_dates_sorted = sorted(matching_dates, reverse=True)
-                        latest_expiry = matching_dates_sorted[0]
+
+                    if latest_expiry is not None:
                         # Convert from "2025-11-25T14:30:00" to "25Nov2025" format
-                        dt = datetime.strptime(latest_expiry, "%Y-%m-%dT%H:%M:%S")
+                        dt = datetime.fromisoformat(latest_expiry)
                         expiry_date = f"{dt.day:02d}{month_names[dt.month-1]}{dt.year}"
-                        log_line(f"Monthly expiry: Using expiry date {expiry_date} for {parsed['symbol']} (matched from {len(matching_dates)} dates in {month_names[target_month-1]} {target_year})")
+                        log.info(f"Monthly expiry: Using expiry date {expiry_date} for {parsed.symbol} (matched from {matched} dates in {month_names[target_month-1]} {target_year})")
                     else:
-                        log_line(f"No matching expiry date found for {parsed['symbol']} in {month_names[target_month-1]} {target_year} from {len(expiry_dates)} available dates")
+                        log.info(f"No matching expiry date found for {parsed.symbol} in {month_names[target_month-1]} {target_year} from {len(expiry_dates)} available dates")
                 elif expiry_resp and expiry_resp.get("type") == "error":
-                    log_line(f"get_expiry_date error for {parsed['symbol']}: {expiry_resp.get('description', expiry_resp)}")
+                    log.info(f"get_expiry_date error for {parsed.symbol}: {expiry_resp.get('description', expiry_resp)}")
                 else:
-                    log_line(f"get_expiry_date unexpected response for {parsed['symbol']}: {expiry_resp}")
+                    log.info(f"get_expiry_date unexpected response for {parsed.symbol}: {expiry_resp}")
             except Exception as e:
-                log_line(f"Error fetching expiry date for monthly expiry {tradingsymbol}: {e}")
+                log.info(f"Error fetching expiry date for monthly expiry {tradingsymbol}: {e}")
                 # Fall back to parsed expiry_date
         
         resp = xm.get_option_symbol(
             exchangeSegment=exchange_segment,
-            series=parsed["series"],
-            symbol=parsed["symbol"],
+            series=parsed.series,
+            symbol=parsed.symbol,
             expiryDate=expiry_date,
-            optionType=parsed["option_type"],
-            strikePrice=parsed["strike"],
+            optionType=parsed.option_type,
+            strikePrice=parsed.strike,
         )
         if resp and resp.get("type") == "success" and resp.get("result"):
+            _INSTR_CACHE[instr_key] = resp["result"][0]
             return resp["result"][0]
         else:
-            log_line(f"get_option_symbol failed for {tradingsymbol}: {resp}")
+            log.info(f"get_option_symbol failed for {tradingsymbol}: {resp}")
     except Exception as e:
-        log_line(f"Error resolving {tradingsymbol}: {e}")
+        log.info(f"Error resolving {tradingsymbol}: {e}")
     return None
 
 
-def parse_zerodha_option_symbol(sym: str) -> Dict[str, Any]:
-    i = 0
-    while i < len(sym) and sym[i].isalpha():
-        i += 1
-    underlying = sym[:i]
-    rest = sym[i:]
-    
-    # Month name mapping (3-char to full name) - for MONTHLY expiry
-    month_name_map = {
-        'JAN': 'Jan', 'FEB': 'Feb', 'MAR': 'Mar', 'APR': 'Apr', 'MAY': 'May', 'JUN': 'Jun',
-        'JUL': 'Jul', 'AUG': 'Aug', 'SEP': 'Sep', 'OCT': 'Oct', 'NOV': 'Nov', 'DEC': 'Dec'
-    }
-    # Single char month code mapping - for WEEKLY expiry
-    mon_map = {
-        'J': 'Jan', 'F': 'Feb', 'M': 'Mar', 'A': 'Apr', 'Y': 'May', 'H': 'Jun',
-        'G': 'Jul', 'U': 'Aug', 'S': 'Sep', 'O': 'Oct', 'N': 'Nov', 'D': 'Dec'
-    }
-    
-    yy = rest[:2]
-    yyyy = f"20{yy}"
-    
-    # Check if month is 3-char format (MONTHLY) or single char (WEEKLY)
-    month_part = rest[2:5].upper()  # Try 3-char first (MONTHLY format)
-    is_monthly_expiry = month_part in month_name_map
-    
+class ParsedOption(NamedTuple):
+    symbol: str
+    expiry_api_format: str
+    option_type: str
+    strike: int
+    series: str
+    is_monthly_expiry: bool  # Flag to indicate if we need to fetch actual expiry date
+
+
+@lru_cache(maxsize=4096)
+def parse_zerodha_option_symbol(sym: str) -> ParsedOption:
+    # MONTHLY: BANKNIFTY25NOV59500CE -> SYMBOL + YY + MONTHNAME + STRIKE + OPTTYPE (no day)
+    # WEEKLY:  NIFTY25N1125550CE    -> SYMBOL + YY + M + DD + STRIKE + OPTTYPE (25 = year, N = month, 11 = day)
+    m = _OPT_RE.match(sym)
+    if not m:
+        raise ValueError(f"Unrecognised option symbol: {sym}")
+    underlying, yy, month_part, mon_code, dd, strike_str, opt_type = m.groups()
+
+    is_monthly_expiry = month_part is not None
     if is_monthly_expiry:
-        # MONTHLY format: BANKNIFTY25NOV59500CE
-        # Format: SYMBOL + YY + MONTHNAME + STRIKE + OPTTYPE
-        # No day in monthly expiry symbols
-        mon = month_name_map[month_part]
+        mon = _MONTH_NAME_MAP[month_part]
         # For monthly expiry, use "01" as default day (will be replaced by API call)
         dd = "01"
-        tail = rest[5:]  # Strike starts immediately after 3-char month
     else:
-        # WEEKLY format: NIFTY25N1125550CE
-        # Format: SYMBOL + YY + M + DD + STRIKE + OPTTYPE
-        # 25 = year, N = month, 11 = day
-        mon_code = rest[2]
-        mon = mon_map[mon_code]
-        dd = rest[3:5]  # Day is 2 digits after single char month
-        tail = rest[5:]  # Strike starts after day
-    
-    opt_type = "PE" if tail.endswith("PE") else "CE"
-    strike_str = tail[:-2]
-    strike = int(strike_str)
-    
-    expiry_api_format = f"{dd}{mon}{yyyy}"
-    idx_symbols = {"NIFTY", "BANKNIFTY", "FINNIFTY", "MIDCPNIFTY"}
-    series = "OPTIDX" if underlying in idx_symbols else "OPTSTK"
-    
-    return {
-        "symbol": underlying,
-        "expiry_api_format": expiry_api_format,
-        "option_type": opt_type,
-        "strike": strike,
-        "series": series,
-        "is_monthly_expiry": is_monthly_expiry,  # Flag to indicate if we need to fetch actual expiry date
-    }
+        mon = _MON_MAP.get(mon_code)
+        if mon is None:
+            raise ValueError(f"Unknown month code: {mon_code} in {sym}")
+
+    expiry_api_format = f"{dd}{mon}20{yy}"
+    series = "OPTIDX" if underlying in _IDX_SYMBOLS else "OPTSTK"
+    return ParsedOption(underlying, expiry_api_format, opt_type, int(strike_str), series, is_monthly_expiry)
 
 
-def get_exchange_segment_numeric_for_marketdata(symbol: str) -> int:
+def order_ts_key(ts: Any) -> str:
+    """Normalise a Kite order timestamp (datetime or "YYYY-MM-DD HH:MM:SS") to a sortable string."""
+    if isinstance(ts, datetime):
+        return ts.strftime("%Y-%m-%d %H:%M:%S")
+    return str(ts) if ts else ""
+
+
+def advance_cursor(orders: list, seen: set, cursor: str) -> str:
+    """Return the newest timestamp below which every order is settled.
+
+    Orders older than the cursor are skipped on the next poll. An order still
+    waiting to be copied (not yet in `seen` and not REJECTED/CANCELLED) pins the
+    cursor at its own timestamp, so it is re-examined until it completes.
+    """
+    pending = []
+    newest = cursor
+    for o in orders:
+        key = order_ts_key(o.get("order_timestamp"))
+        if not key:
+            continue
+        if key > newest:
+            newest = key
+        if str(o.get("order_id")) not in seen and o.get("status") not in _SETTLED_STATUSES:
+            pending.append(key)
+    if pending:
+        return max(cursor, min(pending))
+    return newest
+
+
+def fetch_orders(kite: KiteConnect, cursor: str) -> list:
+    """Zerodha orders not older than `cursor`; older, settled rows are dropped while parsing.
+
+    Uses ijson over the raw `/orders` response when available (timestamps stay strings),
+    otherwise `kite.orders()`.
+    """
+    if ijson is None:
+        return kite.orders()
+    resp = kite.reqsession.get(
+        kite.root + kite._routes["orders"],
+        headers={
+            "X-Kite-Version": kite.kite_header_version,
+            "User-Agent": kite._user_agent(),
+            "Authorization": f"token {kite.api_key}:{kite.access_token}",
+        },
+        verify=not kite.disable_ssl,
+        timeout=kite.timeout,
+        proxies=kite.proxies,
+        stream=True,
+    )
+    try:
+        resp.raise_for_status()
+        resp.raw.decode_content = True
+        out = []
+        for o in ijson.items(resp.raw, "data.item", use_float=True):
+            ts_key = order_ts_key(o.get("order_timestamp"))
+            if ts_key and ts_key < cursor:
+                continue
+            out.append(o)
+        return out
+    finally:
+        resp.close()
+
+
+def get_exchange_segment_numeric_for_marketdata(underlying: str) -> int:
     """Determine exchange segment (numeric) for market data API calls.
-    Returns 2 for NSEFO (NIFTY, BANKNIFTY, MIDCPNIFTY, FINNIFTY)
-    Returns 12 for BSEFO (SENSEX)
+    Returns 12 for BSEFO (SENSEX, BANKEX)
+    Returns 2 for NSEFO (NIFTY, BANKNIFTY, MIDCPNIFTY, FINNIFTY and everything else)
     """
-    symbol_upper = symbol.upper()
-    if "SENSEX" in symbol_upper:
-        return 12  # BSEFO
-    # Default to NSEFO for NIFTY, BANKNIFTY, MIDCPNIFTY, FINNIFTY
-    return 2  # NSEFO
+    return 12 if underlying in _BSE_UNDERLYINGS else 2
 
 
-def get_exchange_segment_string_for_order(symbol: str) -> str:
+def get_exchange_segment_string_for_order(underlying: str) -> str:
     """Determine exchange segment (string) for order placement.
-    Returns "NSEFO" for NIFTY, BANKNIFTY, MIDCPNIFTY, FINNIFTY
-    Returns "BSEFO" for SENSEX
+    Returns "BSEFO" for SENSEX, BANKEX
+    Returns "NSEFO" for NIFTY, BANKNIFTY, MIDCPNIFTY, FINNIFTY and everything else
+    """
+    return XTSConnect.EXCHANGE_BSEFO if underlying in _BSE_UNDERLYINGS else XTSConnect.EXCHANGE_NSEFO
+
+
+def get_quotes(xm: XTSConnect, items: List[Tuple[int, str]]) -> Dict[int, Tuple[Optional[float], Optional[float]]]:
+    """Fetch best (bid, ask) for several instruments in one get_quote call.
+
+    `items` is a list of (exchangeInstrumentID, underlying); the underlying picks the
+    market-data segment. Instruments missing from the response are absent from the result.
     """
-    symbol_upper = symbol.upper()
-    # Check if symbol contains NIFTY, BANKNIFTY, MIDCPNIFTY, or FINNIFTY
-    if any(x in symbol_upper for x in ["NIFTY", "BANKNIFTY", "MIDCPNIFTY", "FINNIFTY"]):
-        return XTSConnect.EXCHANGE_NSEFO  # "NSEFO"
-    elif "SENSEX" in symbol_upper:
-        return XTSConnect.EXCHANGE_BSEFO  # "BSEFO"
-    # Default to NSEFO
-    return XTSConnect.EXCHANGE_NSEFO  # "NSEFO"
-
-
-def get_ask(xm: XTSConnect, nfo_ins_id: int, symbol: str) -> Optional[float]:
-    """Get best ask price for an instrument."""
+    quotes: Dict[int, Tuple[Optional[float], Optional[float]]] = {}
+    if not items:
+        return quotes
     try:
-        exchange_segment = get_exchange_segment_numeric_for_marketdata(symbol)
+        instruments = []
+        for ins_id, underlying in dict(items).items():
+            instruments.append({"exchangeSegment": get_exchange_segment_numeric_for_marketdata(underlying),
+                                "exchangeInstrumentID": ins_id})
         response = xm.get_quote(
-            Instruments=[{"exchangeSegment": exchange_segment, "exchangeInstrumentID": nfo_ins_id}],
+            Instruments=instruments,
             xtsMessageCode=1502,
             publishFormat='JSON'
         )
-        
+
         if not response or response.get("type") != "success":
-            log_line(f"Error getting ask price: {response}")
-            return None
-            
-        list_quotes = response['result']['listQuotes'][0]
-        quote_data = json.loads(list_quotes)
-        
-        # Best Ask = first entry in Asks (lowest price)
-        if quote_data.get('Asks') and len(quote_data['Asks']) > 0:
-            ask_price = quote_data['Asks'][0]['Price']
-            return float(ask_price)
-        return None
+            log.info(f"Error getting quotes: {response}")
+            return quotes
+
+        for list_quotes in response['result']['listQuotes']:
+            quote_data = _json_loads(list_quotes)
+            # Best Bid = first entry in Bids (highest price); Best Ask = first entry in Asks (lowest price)
+            bids, asks = quote_data.get('Bids'), quote_data.get('Asks')
+            bid = float(bids[0]['Price']) if bids else None
+            ask = float(asks[0]['Price']) if asks else None
+            quotes[int(quote_data.get('ExchangeInstrumentID'))] = (bid, ask)
     except Exception as e:
-        log_line(f"Error getting ask price: {e}")
-        return None
+        log.info(f"Error getting quotes: {e}")
+    return quotes
+
+
+def adjust_limit_price_paise(price: float, side: str, tick_paise: int = 5, bps: int = 100) -> float:
+    """Move `price` `bps` basis points through the market and snap it to the tick.
 
+    Works in integer paise so tick boundaries are exact: BUY rounds up, SELL rounds down.
+    """
+    p = round(price * 100)
+    bump = (p * bps + 9999) // 10000
+    if side == "BUY":
+        p += bump
+        p = ((p + tick_paise - 1) // tick_paise) * tick_paise
+    else:
+        p -= bump
+        p = (p // tick_paise) * tick_paise
+    return p / 100.0
+
+
+@dataclass
+class CopyState:
+    """Everything the copy loop needs to mirror one batch of Zerodha orders."""
+    xm: XTSConnect
+    xt_i: XTSConnect
+    mapping: Dict[str, Any]
+    mapping_path: Path
+    journal: OrderJournal
+    seen: set
+    multiplier: int
+    start_time: datetime
+    executor: ThreadPoolExecutor = field(default_factory=lambda: ThreadPoolExecutor(max_workers=MAX_WORKERS))
+    lock: threading.Lock = field(default_factory=threading.Lock)  # guards mapping, journal and seen
+    dirty: bool = False  # header (_cursor) changed since the last save
+
+
+def start_order_stream(api_key: str, access_token: str, order_queue: "queue.Queue[Dict[str, Any]]") -> KiteTicker:
+    """Connect KiteTicker in a background thread and enqueue every pushed order update."""
+    ticker = KiteTicker(api_key, access_token)
+
+    def on_order_update(ws, data):
+        order_queue.put(data)
+
+    def on_connect(ws, response):
+        log.info("Zerodha order stream connected")
+
+    def on_close(ws, code, reason):
+        log.info(f"Zerodha order stream closed: {code} {reason}; polling REST until it reconnects")
+
+    ticker.on_order_update = on_order_update
+    ticker.on_connect = on_connect
+    ticker.on_close = on_close
+    ticker.connect(threaded=True)
+    return ticker
+
+
+def close_mapping(state: CopyState, journal_path: Path) -> None:
+    """On exit: close the journal, then fold it into one line per order and save the header."""
+    with state.lock:
+        state.journal.close()
+        compact_journal(journal_path, state.mapping["orders"])
+        save_mapping(state.mapping_path, state.mapping)
+
+
+def mark_prestart_orders(state: CopyState, orders: list) -> None:
+    """First run: record every order already in the orderbook as skipped, without copying."""
+    mapping, seen = state.mapping, state.seen
+    mapping["_started"] = datetime.now().isoformat()
+    # Mark all existing orders as seen without copying, with log
+    log.info(f"Fetched {len(orders)} existing orders before copier start. These will NOT be tracked.")
+    snapshot = {str(ho.get("order_id")): ho for ho in orders}
+    new_ids = snapshot.keys() - seen
+    # Keep orderbook order so the journal and log read chronologically
+    skipped = {hid: {"skipped": True, "reason": "opened before start"} for hid in snapshot if hid in new_ids}
+    seen |= new_ids
+    for hid in skipped:
+        ho = snapshot[hid]
+        log.info(f"Pre-start order not tracked: Z {hid} symbol={ho.get('tradingsymbol')} status={ho.get('status')}")
+    mapping["orders"].update(skipped)
+    append_orders(state.journal, skipped)
+    # Records before the header, so a saved _started always has its snapshot on disk
+    state.journal.flush()
+    save_mapping(state.mapping_path, mapping)
+
+
+def record_outcome(state: CopyState, zid: str, record: Optional[Dict[str, Any]] = None,
+                   durable: bool = False) -> None:
+    """Mark a Zerodha order as handled, journaling `record` if given; safe across worker threads.
+
+    The journal is flushed once per batch by flush_mapping; `durable` flushes it right away.
+    """
+    with state.lock:
+        if record is not None:
+            state.mapping["orders"][zid] = record
+            append_orders(state.journal, {zid: record})
+            if durable:
+                state.journal.flush()
+        state.seen.add(zid)
+
+
+def flush_mapping(state: CopyState) -> None:
+    """End of a batch: flush journaled records and rewrite the header if it changed."""
+    with state.lock:
+        state.journal.flush()
+        if state.dirty:
+            save_mapping(state.mapping_path, state.mapping)
+            state.dirty = False
+
+
+def _map_orders(state: CopyState, fn, items: list) -> list:
+    """map() over a batch, on the worker pool when there is more than one item."""
+    if len(items) <= 1:
+        return [fn(item) for item in items]
+    return list(state.executor.map(fn, items))
+
+
+def place_copy(state: CopyState, zid: str, symbol: str, underlying: str, side: str, qty: int,
+               exchange_instrument_id: Any, tick_paise: int, quote: Tuple[Optional[float], Optional[float]]) -> None:
+    """Place the 5paisa LIMIT order mirroring one Zerodha fill and record the outcome."""
+    xt_i, multiplier = state.xt_i, state.multiplier
+    # Determine exchange segment from the underlying (string for order placement)
+    exchange_segment = get_exchange_segment_string_for_order(underlying)
+    target_qty = max(1, int(qty) * multiplier)
+
+    # Get price based on order side
+    bid, ask = quote
+    price = ask if side == "BUY" else bid
+    if price is None:
+        log.info(f"Failed to get {'ask' if side == 'BUY' else 'bid'} price for {symbol}; skipping Z {zid}")
+        record_outcome(state, zid)
+        return
+
+    # Adjust price: add 1% for BUY, subtract 1% for SELL, snapped to the tick
+    adjusted_price = adjust_limit_price_paise(price, side, tick_paise)
+
+    # Use XTS constants
+    order_side_val = XTSConnect.TRANSACTION_TYPE_BUY if side == "BUY" else XTSConnect.TRANSACTION_TYPE_SELL
+
+    # Place LIMIT order on 5paisa
+    params = {
+        "exchangeSegment": exchange_segment,
+        "exchangeInstrumentID": exchange_instrument_id,
+        "productType": XTSConnect.PRODUCT_MIS,
+        "orderType": XTSConnect.ORDER_TYPE_LIMIT,
+        "orderSide": order_side_val,
+        "timeInForce": XTSConnect.VALIDITY_DAY,
+        "disclosedQuantity": 0,
+        "orderQuantity": target_qty,
+        "limitPrice": adjusted_price,
+        "stopPrice": 0,
+        "orderUniqueIdentifier": f"Z2F-{zid}",
+        "apiOrderSource": "WEBAPI",
+    }
 
-def get_bid(xm: XTSConnect, nfo_ins_id: int, symbol: str) -> Optional[float]:
-    """Get best bid price for an instrument."""
+    log.info(f"Z COMPLETE {zid} {symbol} {side} zqty={qty} -> 5p qty={target_qty} inst={exchange_instrument_id} price={price:.2f} adjusted={adjusted_price:.2f}")
     try:
-        exchange_segment = get_exchange_segment_numeric_for_marketdata(symbol)
-        response = xm.get_quote(
-            Instruments=[{"exchangeSegment": exchange_segment, "exchangeInstrumentID": nfo_ins_id}],
-            xtsMessageCode=1502,
-            publishFormat='JSON'
-        )
-        
-        if not response or response.get("type") != "success":
-            log_line(f"Error getting bid price: {response}")
-            return None
-            
-        list_quotes = response['result']['listQuotes'][0]
-        quote_data = json.loads(list_quotes)
-        
-        # Best Bid = first entry in Bids (highest price)
-        if quote_data.get('Bids') and len(quote_data['Bids']) > 0:
-            bid_price = quote_data['Bids'][0]['Price']
-            return float(bid_price)
-        return None
+        if DEBUG:
+            log.info("5paisa params: " + json.dumps(params))
+
+        presp = xt_i.place_order(**params)
+        if DEBUG:
+            log.info(f"5paisa response: {presp}")
+
+        if presp and presp.get("type") == "success":
+            fivep_id = presp.get("result", {}).get("AppOrderID") or presp.get("result", {}).get("appOrderID")
+            # A placed order must never be copied twice, so its record is flushed at once
+            record_outcome(state, zid, {"fivep": fivep_id, "symbol": symbol, "side": side, "qty": qty, "tqty": target_qty},
+                           durable=True)
+            log.info(f"Mapped Z {zid} -> 5p {fivep_id}", extra=_FLUSH)
+        else:
+            # Do NOT retry: mark seen and log status/description once
+            status = presp.get("code") if isinstance(presp, dict) else None
+            desc = presp.get("description") if isinstance(presp, dict) else str(presp)
+            log.info(f"5p order not completed for Z {zid} (no retry). status={status} desc={desc}", extra=_FLUSH)
+            record_outcome(state, zid)
     except Exception as e:
-        log_line(f"Error getting bid price: {e}")
-        return None
+        # Do NOT retry on exception either
+        log.info(f"5p place order exception for Z {zid} (no retry): {e}", extra=_FLUSH)
+        record_outcome(state, zid)
+
+
+def process_orders(state: CopyState, orders: list, full_snapshot: bool) -> int:
+    """Copy every new COMPLETE order in `orders` to 5paisa; returns how many were new.
+
+    `full_snapshot` is True for a complete `kite.orders()` listing (which may move the
+    cursor) and False for orders pushed over the websocket.
+    """
+    xm = state.xm
+    mapping, seen = state.mapping, state.seen
+    start_time = state.start_time
+
+    # The cursor only applies to full orderbook snapshots; pushed updates are always fresh
+    cursor = (mapping.get("_cursor") or "") if full_snapshot else ""
+    # (zid, exchange, symbol, side, zerodha qty, timestamp key) of new fills to copy in this batch
+    candidates: List[Tuple[str, str, str, str, int, str]] = []
+    queued = set()
+    # Convert start_time (UTC) to local naive datetime for comparison with order timestamps
+    start_dt_local = start_time.astimezone().replace(tzinfo=None)
+    for o in orders:
+        ts = o.get("order_timestamp")
+        # Everything older than the cursor was settled on an earlier poll
+        ts_key = order_ts_key(ts)
+        if ts_key and ts_key < cursor:
+            continue
+        zid = str(o.get("order_id"))
+        # A pushed batch can carry the same fill twice; queue each order once
+        if zid in seen or zid in queued:
+            continue
+        # Kite reports statuses in upper case already
+        if o.get("status") != "COMPLETE":
+            continue
+
+        # Only new fills get unpacked further
+        exch = o.get("exchange")
+        symbol = o.get("tradingsymbol")
+        # A COMPLETE order is fully filled; quantity is only a fallback for odd payloads
+        qty = int(o.get("filled_quantity") or o.get("quantity") or 0)
+        side = (o.get("transaction_type") or "").upper()
+
+        # For subsequent runs, skip orders timestamped before start_time
+        if isinstance(ts, str) and ts:
+            try:
+                # Kite sends "%Y-%m-%d %H:%M:%S" in local time, naive
+                ts_dt: Optional[datetime] = datetime.fromisoformat(ts)
+            except ValueError as e:
+                # Better to skip than copy an order we cannot place in time
+                log.info(f"Error parsing order timestamp for Z {zid}: {e}")
+                seen.add(zid)
+                continue
+        else:
+            ts_dt = ts if isinstance(ts, datetime) else None
+        if ts_dt is not None and ts_dt.replace(tzinfo=None) < start_dt_local:
+            record_outcome(state, zid, {"skipped": True, "reason": "opened before start"})
+            log.info(f"Pre-start order skipped: Z {zid} symbol={symbol} timestamp={ts}")
+            continue
+
+        candidates.append((zid, exch, symbol, side, qty, ts_key))
+        queued.add(zid)
+
+    # Resolve instruments on 5paisa; master misses fall back to REST, so overlap them
+    insts = _map_orders(state, lambda c: resolve_5p_instrument(xm, c[1], c[2]), candidates)
+    # Placement args per 5paisa instrument, with the Zerodha timestamp key to order them by
+    pending: Dict[int, List[Tuple[str, tuple]]] = {}
+    for (zid, exch, symbol, side, qty, ts_key), inst in zip(candidates, insts):
+        if not inst:
+            log.info(f"Resolve failed for {symbol} ({exch}); skipping Z {zid}")
+            record_outcome(state, zid)
+            continue
+        exchange_instrument_id = inst.get("ExchangeInstrumentID")
+        if exchange_instrument_id is None:
+            log.info(f"No ExchangeInstrumentID for {symbol} ({exch}); skipping Z {zid}")
+            record_outcome(state, zid)
+            continue
+        tick_paise = max(1, round(float(inst.get("TickSize") or 0.05) * 100))
+        # Segment classification only depends on the underlying (parse is cached)
+        underlying = parse_zerodha_option_symbol(symbol).symbol
+        pending.setdefault(int(exchange_instrument_id), []).append(
+            (ts_key, (zid, symbol, underlying, side, qty, exchange_instrument_id, tick_paise)))
+
+    def place_group(group: List[Tuple[str, tuple]]) -> None:
+        # Same contract: place in Zerodha's order, so a SELL never overtakes the BUY it closes
+        # (stable sort keeps arrival order for equal or missing timestamps)
+        for _, args in sorted(group, key=lambda g: g[0]):
+            place_copy(state, *args, quotes.get(int(args[5]), (None, None)))
+
+    # One quote round-trip for every instrument in this batch; only different instruments run in parallel
+    quotes = get_quotes(xm, [(group[0][1][5], group[0][1][2]) for group in pending.values()])
+    _map_orders(state, place_group, list(pending.values()))
+
+    if full_snapshot:
+        new_cursor = advance_cursor(orders, seen, cursor)
+        if new_cursor != cursor:
+            mapping["_cursor"] = new_cursor
+            state.dirty = True
+    return len(candidates)
 
 
 def main() -> None:
+    # One long-lived, buffered handle on Orderlog.txt; logging.shutdown flushes it at exit
+    file_handler = BufferedFileHandler(ORDER_LOG, encoding="utf-8")
+    handlers = [file_handler, logging.StreamHandler(sys.stdout)]
+    formatter = LineFormatter("[%(asctime)s] %(message)s")
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    logging.basicConfig(level=logging.INFO, handlers=handlers)
     start_time = datetime.now(timezone.utc)
     mapping_path = Path(MAPPING_FILE)
-    mapping = load_mapping(mapping_path)
+    journal_path = Path(JOURNAL_FILE)
+    mapping = load_mapping(mapping_path, journal_path)
+    # Fold the previous session's journal (and any legacy full copy_map.json) into one line per order
+    compact_journal(journal_path, mapping["orders"])
+    save_mapping(mapping_path, mapping)
+    # Records are flushed per batch, placements immediately (see record_outcome)
+    journal = OrderJournal(journal_path)
 
     # Read creds
-    z_creds = read_csv_kv(Path(Z_CRED_CSV))
+    z_creds = load_zerodha_creds(Path(Z_CRED_CSV))
     fp_creds = read_csv_kv(Path(FP_CRED_CSV))
 
     # Zerodha login
-    api_key = z_creds.get("key") or z_creds.get("api_key")
-    api_secret = z_creds.get("secret") or z_creds.get("api_secret")
-    request_token = z_creds.get("request_token")
-    user_id = z_creds.get("id") or z_creds.get("userid") or z_creds.get("zerodhauserid")
-    password = z_creds.get("pwd") or z_creds.get("password") or z_creds.get("zerodhapassword")
-    totp_secret = z_creds.get("zerodha2fa") or z_creds.get("2fa") or z_creds.get("totp")
-
-    if request_token:
-        kite, _ = z_login(api_key=api_key, api_secret=api_secret, request_token=request_token)
+    api_key = z_creds.api_key
+    if z_creds.request_token:
+        kite, access_token = z_login(api_key=api_key, api_secret=z_creds.api_secret, request_token=z_creds.request_token)
     else:
-        kite, _ = z_login(api_key=api_key, api_secret=api_secret, user_id=user_id, password=password, totp_secret=totp_secret, headless=False)
-    log_line("Successful login to Zerodha")
+        kite, access_token = z_login(api_key=api_key, api_secret=z_creds.api_secret, user_id=z_creds.user_id,
+                                     password=z_creds.password, totp_secret=z_creds.totp_secret, headless=False)
+    log.info("Successful login to Zerodha")
 
     # 5paisa login
-    log_line("Starting 5paisa login...")
+    log.info("Starting 5paisa login...")
     interactive_key = fp_creds.get("interactive_api_key")
     interactive_secret = fp_creds.get("interactive_api_secret")
     market_key = fp_creds.get("market_data_api_key")
     market_secret = fp_creds.get("market_data_api_secret_key")
     source = fp_creds.get("source") or "WEBAPI"
 
-    log_line("Attempting 5paisa Interactive login...")
-    xt_i = XTSConnect(apiKey=interactive_key, secretKey=interactive_secret, source=source)
+    log.info("Attempting 5paisa Interactive login...")
+    xt_i = XTSConnect(apiKey=interactive_key, secretKey=interactive_secret, source=source, pool=http_pool(XTS_POOL_SIZE))
     iresp = xt_i.interactive_login()
-    log_line(f"5paisa Interactive login response: {json.dumps(iresp, indent=2)}")
+    log.info(f"5paisa Interactive login type={_resp_field(iresp, 'type')} code={_resp_field(iresp, 'code')}")
+    if DEBUG:
+        log.info(f"5paisa Interactive login response: {iresp}")
     if not iresp or iresp.get("type") != "success":
-        log_line(f"5paisa interactive login failed: {iresp}")
+        log.info(f"5paisa interactive login failed: {_resp_field(iresp, 'description') or iresp}", extra=_FLUSH)
         sys.exit(2)
-    log_line("5paisa Interactive login successful")
+    log.info("5paisa Interactive login successful")
     
-    log_line("Attempting 5paisa MarketData login...")
-    xm = XTSConnect(apiKey=market_key, secretKey=market_secret, source=source)
+    log.info("Attempting 5paisa MarketData login...")
+    xm = XTSConnect(apiKey=market_key, secretKey=market_secret, source=source, pool=http_pool(XTS_POOL_SIZE))
     mresp = xm.marketdata_login()
-    log_line(f"5paisa MarketData login response: {json.dumps(mresp, indent=2)}")
+    log.info(f"5paisa MarketData login type={_resp_field(mresp, 'type')} code={_resp_field(mresp, 'code')}")
+    if DEBUG:
+        log.info(f"5paisa MarketData login response: {mresp}")
     if not mresp or mresp.get("type") != "success":
-        log_line(f"5paisa marketdata login failed: {mresp}")
+        log.info(f"5paisa marketdata login failed: {_resp_field(mresp, 'description') or mresp}", extra=_FLUSH)
         sys.exit(3)
-    log_line("5paisa MarketData login successful")
-    log_line("Successful login to 5paisa (Interactive + MarketData)")
+    log.info("5paisa MarketData login successful")
+    log.info(f"Loaded {load_instrument_master(xm)} option contracts from the 5paisa instrument master")
+    log.info("Successful login to 5paisa (Interactive + MarketData)")
 
-    multiplier = read_multiplier(z_creds)
-    log_line(f"Copy trader started. Multiplier={multiplier}")
+    multiplier = read_multiplier(z_creds.multiplier)
+    log.info(f"Copy trader started. Multiplier={multiplier}")
 
     seen = set(mapping.get("orders", {}).keys())
 
-    log_line("Starting copy loop: polling Zerodha orders...")
-    while True:
+    state = CopyState(xm=xm, xt_i=xt_i, mapping=mapping, mapping_path=mapping_path,
+                      journal=journal, seen=seen,
+                      multiplier=multiplier, start_time=start_time)
+    atexit.register(close_mapping, state, journal_path)
+    # SIGTERM would otherwise kill the process without running atexit hooks
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # First run: snapshot the orderbook once so nothing placed before start is copied
+    while mapping.get("_started") is None:
         try:
-            orders = kite.orders()
+            mark_prestart_orders(state, kite.orders())
         except Exception as e:
-            log_line(f"Error fetching Zerodha orders: {e}")
-            time.sleep(2)
-            continue
-
-        for o in orders:
-            zid = str(o.get("order_id"))
-            status = (o.get("status") or "").upper()
-            ts = o.get("order_timestamp")
-            exch = o.get("exchange")
-            symbol = o.get("tradingsymbol")
-            qty = int(o.get("filled_quantity") or o.get("quantity") or 0)
-            side = (o.get("transaction_type") or "").upper()
+            log.info(f"Error fetching Zerodha orders for the start snapshot: {e}")
+            time.sleep(POLL_INTERVAL)
 
-            if zid in seen:
-                continue
+    # Order updates are pushed over the Kite websocket; REST polling only reconciles
+    order_queue: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+    ticker = start_order_stream(api_key, access_token, order_queue)
 
-            if status != "COMPLETE":
+    log.info("Starting copy loop: streaming Zerodha order updates...")
+    last_poll: Optional[float] = None  # None: reconcile at once so the start-of-day snapshot sees the full orderbook
+    poll_interval = float(POLL_INTERVAL)
+    while True:
+        # Websocket down: fall back to adaptive polling until it reconnects
+        interval = RECONCILE_INTERVAL if ticker.is_connected() else poll_interval
+        wait = 0.0 if last_poll is None else last_poll + interval - time.monotonic()
+        if wait > 0:
+            try:
+                # Wake up at least every POLL_INTERVAL to re-check the connection state
+                first = order_queue.get(timeout=min(wait, POLL_INTERVAL))
+            except queue.Empty:
                 continue
-
-            # Check if order was created before application start
-            # First-run: mark all existing orders as seen without copying
-            if mapping.get("_started") is None:
-                mapping["_started"] = datetime.now().isoformat()
-                save_mapping(mapping_path, mapping)
-                # Mark all existing orders as seen without copying, with log
-                log_line(f"Fetched {len(orders)} existing orders before copier start. These will NOT be tracked.")
-                for ho in orders:
-                    hid = str(ho.get("order_id"))
-                    if hid not in seen:
-                        mapping["orders"][hid] = {"skipped": True, "reason": "opened before start"}
-                        seen.add(hid)
-                        log_line(f"Pre-start order not tracked: Z {hid} symbol={ho.get('tradingsymbol')} status={ho.get('status')}")
-                save_mapping(mapping_path, mapping)
-                # After initial snapshot, continue to next poll iteration
-                time.sleep(2)
-                break
-
-            # For subsequent runs, check if order timestamp is before start_time
-            if ts:
+            updates = [first]
+            while True:
                 try:
-                    # Handle both string and datetime object timestamps
-                    if isinstance(ts, datetime):
-                        # Already a datetime object, make it naive (remove timezone if present)
-                        order_dt = ts.replace(tzinfo=None) if ts.tzinfo else ts
-                    elif isinstance(ts, str):
-                        # Parse string timestamp (format: "%Y-%m-%d %H:%M:%S" in local time, naive)
-                        order_dt = datetime.strptime(ts, "%Y-%m-%d %H:%M:%S")
-                    else:
-                        # Unknown type, skip this check
-                        order_dt = None
-                    
-                    if order_dt:
-                        # Convert start_time (UTC) to local naive datetime for comparison
-                        start_dt_local = start_time.astimezone().replace(tzinfo=None)
-                        if order_dt < start_dt_local:
-                            # Order was created before app start, skip it
-                            mapping["orders"][zid] = {"skipped": True, "reason": "opened before start"}
-                            seen.add(zid)
-                            log_line(f"Pre-start order skipped: Z {zid} symbol={symbol} timestamp={ts}")
-                            continue
-                except Exception as e:
-                    # If timestamp parsing fails, log and continue (better to skip than copy wrong order)
-                    log_line(f"Error parsing order timestamp for Z {zid}: {e}")
-                    seen.add(zid)
-                    continue
-
-            # Resolve instrument on 5paisa
-            inst = resolve_5p_instrument(xm, exch, symbol)
-            if not inst:
-                log_line(f"Resolve failed for {symbol} ({exch}); skipping Z {zid}")
-                seen.add(zid)
-                continue
-
-            # Determine exchange segment from symbol (string for order placement)
-            exchange_segment = get_exchange_segment_string_for_order(symbol)
-            exchange_instrument_id = inst.get("ExchangeInstrumentID")
-            target_qty = max(1, int(qty) * multiplier)
-            
-            # Get price based on order side
-            price = None
-            if side == "BUY":
-                price = get_ask(xm, exchange_instrument_id, symbol)
-                if price is None:
-                    log_line(f"Failed to get ask price for {symbol}; skipping Z {zid}")
-                    seen.add(zid)
-                    continue
-            else:  # SELL
-                price = get_bid(xm, exchange_instrument_id, symbol)
-                if price is None:
-                    log_line(f"Failed to get bid price for {symbol}; skipping Z {zid}")
-                    seen.add(zid)
-                    continue
-
-            # Adjust price: add 1% for BUY, subtract 1% for SELL
-            one_percent = price * 0.01
-            adjusted_price = price
-            ticksize = 0.05  # Default tick size for options (can be enhanced to fetch from instrument data)
-            
-            if side == "BUY":
-                adjusted_price = price + one_percent
-                # Round up to nearest multiple of ticksize for buy orders
-                if ticksize and ticksize > 0:
-                    adjusted_price = math.ceil(adjusted_price / ticksize) * ticksize
-            else:  # SELL
-                adjusted_price = price - one_percent
-                # Round down to nearest multiple of ticksize for sell orders
-                if ticksize and ticksize > 0:
-                    adjusted_price = math.floor(adjusted_price / ticksize) * ticksize
-
-            # Use XTS constants
-            order_side_val = XTSConnect.TRANSACTION_TYPE_BUY if side == "BUY" else XTSConnect.TRANSACTION_TYPE_SELL
-
-            # Place LIMIT order on 5paisa
-            params = {
-                "exchangeSegment": exchange_segment,
-                "exchangeInstrumentID": exchange_instrument_id,
-                "productType": XTSConnect.PRODUCT_MIS,
-                "orderType": XTSConnect.ORDER_TYPE_LIMIT,
-                "orderSide": order_side_val,
-                "timeInForce": XTSConnect.VALIDITY_DAY,
-                "disclosedQuantity": 0,
-                "orderQuantity": target_qty,
-                "limitPrice": adjusted_price,
-                "stopPrice": 0,
-                "orderUniqueIdentifier": f"Z2F-{zid}",
-                "apiOrderSource": "WEBAPI",
-            }
-
-            log_line(f"Z COMPLETE {zid} {symbol} {side} zqty={qty} -> 5p qty={target_qty} inst={exchange_instrument_id} price={price:.2f} adjusted={adjusted_price:.2f}")
+                    updates.append(order_queue.get_nowait())
+                except queue.Empty:
+                    break
             try:
-                print(f"\n[5paisa] Sending order parameters:")
-                print(f"  exchangeSegment: {params['exchangeSegment']}")
-                print(f"  exchangeInstrumentID: {params['exchangeInstrumentID']}")
-                print(f"  productType: {params['productType']}")
-                print(f"  orderType: {params['orderType']}")
-                print(f"  orderSide: {params['orderSide']}")
-                print(f"  timeInForce: {params['timeInForce']}")
-                print(f"  disclosedQuantity: {params['disclosedQuantity']}")
-                print(f"  orderQuantity: {params['orderQuantity']}")
-                print(f"  limitPrice: {params['limitPrice']}")
-                print(f"  stopPrice: {params['stopPrice']}")
-                print(f"  orderUniqueIdentifier: {params['orderUniqueIdentifier']}")
-                print(f"  apiOrderSource: {params['apiOrderSource']}")
-                print(f"  Original price: {price:.2f}, Adjusted price: {adjusted_price:.2f}")
-                print(f"  Full params dict: {params}\n")
-                
-                presp = xt_i.place_order(**params)
-                
-                print(f"[5paisa] Received response:")
-                print(f"  Response type: {type(presp)}")
-                print(f"  Full response: {presp}\n")
-                
-                if presp and presp.get("type") == "success":
-                    fivep_id = presp.get("result", {}).get("AppOrderID") or presp.get("result", {}).get("appOrderID")
-                    mapping["orders"][zid] = {"fivep": fivep_id, "symbol": symbol, "side": side, "qty": qty, "tqty": target_qty}
-                    save_mapping(mapping_path, mapping)
-                    seen.add(zid)
-                    log_line(f"Mapped Z {zid} -> 5p {fivep_id}")
-                else:
-                    # Do NOT retry: mark seen and log status/description once
-                    status = presp.get("code") if isinstance(presp, dict) else None
-                    desc = presp.get("description") if isinstance(presp, dict) else str(presp)
-                    log_line(f"5p order not completed for Z {zid} (no retry). status={status} desc={desc}")
-                    seen.add(zid)
-            except Exception as e:
-                # Do NOT retry on exception either
-                log_line(f"5p place order exception for Z {zid} (no retry): {e}")
-                seen.add(zid)
+                process_orders(state, updates, full_snapshot=False)
+                # Group-commit: everything this batch journaled or logged goes out in one write
+                flush_mapping(state)
+            except Exception:
+                # Keep copying; fills left unhandled here are picked up by the next reconciliation
+                log.exception("Error copying pushed Zerodha orders", extra=_FLUSH)
+            file_handler.flush()
+            continue
 
-        time.sleep(2)
+        last_poll = time.monotonic()
+        try:
+            orders = fetch_orders(kite, mapping.get("_cursor") or "")
+        except Exception as e:
+            log.info(f"Error fetching Zerodha orders: {e}")
+            continue
+        try:
+            if process_orders(state, orders, full_snapshot=True):
+                poll_interval = max(POLL_INTERVAL_MIN, poll_interval / 2)
+            else:
+                poll_interval = min(POLL_INTERVAL_MAX, poll_interval * 1.5)
+            flush_mapping(state)
+        except Exception:
+            log.exception("Error copying reconciled Zerodha orders", extra=_FLUSH)
+        file_handler.flush()
 
 
 if __name__ == "__main__":
@@ -1,55 +1,31 @@
-import csv
 import sys
 from pathlib import Path
 
-from zerodha_integration import login
+from zerodha_integration import load_zerodha_creds, login
 
 
 CSV_FILENAME = "ZerodhaCredentials.csv"
 
 
-def read_credentials(csv_path: Path) -> dict:
-    creds = {}
-    if not csv_path.exists():
-        raise FileNotFoundError(f"Credentials file not found: {csv_path}")
-
-    with csv_path.open(newline="", encoding="utf-8") as f:
-        reader = csv.reader(f)
-        for row in reader:
-            if not row:
-                continue
-            if len(row) < 2:
-                continue
-            key = (row[0] or "").strip().lower()
-            value = (row[1] or "").strip()
-            if key:
-                creds[key] = value
-    return creds
-
-
 def main() -> None:
     csv_path = Path(__file__).parent / CSV_FILENAME
+    if not csv_path.exists():
+        print(f"Error reading credentials: Credentials file not found: {csv_path}")
+        sys.exit(1)
     try:
-        creds = read_credentials(csv_path)
+        creds = load_zerodha_creds(csv_path)
     except Exception as exc:
         print(f"Error reading credentials: {exc}")
         sys.exit(1)
 
-    # Map expected fields (support multiple naming variants)
-    def first(*keys: str) -> str | None:
-        for k in keys:
-            v = creds.get(k)
-            if v:
-                return v
-        return None
-
-    api_key = first("key", "api_key", "zerodhaapikey")
-    api_secret = first("secret", "api_secret", "zerodhapisecret")
-    request_token = first("request_token")
-    user_id = first("id", "userid", "zerodhauserid")
-    password = first("pwd", "password", "zerodhapassword")
-    totp_secret = first("zerodha2fa", "2fa", "totp", "fa")
-    chromedriver_path = first("chromedriver", "chromedriver_path")
+    # Each field accepts several naming variants (see zerodha_integration.ZERODHA_SCHEMA)
+    api_key = creds.api_key
+    api_secret = creds.api_secret
+    request_token = creds.request_token
+    user_id = creds.user_id
+    password = creds.password
+    totp_secret = creds.totp_secret
+    chromedriver_path = creds.chromedriver_path
 
     # Validate depending on available inputs
     missing = []
@@ -58,9 +34,8 @@ def main() -> None:
     if not api_secret:
         missing.append("api_secret (CSV key: 'secret' or 'ZerodhaApiSecret')")
 
-    if request_token:
-        pass
-    else:
+    # A request_token skips the browser login, so the login fields are only needed without one
+    if not request_token:
         if not user_id:
             missing.append("user_id (CSV key: 'ID' or 'ZerodhaUserId')")
         if not password:
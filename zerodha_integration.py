@@ -1,11 +1,19 @@
 from __future__ import annotations
 
-from typing import Dict, List, Tuple, Optional
-
+from typing import Any, Dict, List, NamedTuple, Tuple, Optional
+
+import atexit
+import contextlib
+import os
+import re
+import tempfile
+import threading
 import time
+from datetime import datetime, time as dtime, timedelta, timezone
 from pathlib import Path
-from urllib.parse import urlparse, parse_qs
+from urllib.parse import urljoin
 
+import requests
 from kiteconnect import KiteConnect
 from selenium import webdriver
 from selenium.webdriver.common.by import By
@@ -15,6 +23,158 @@ from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 import pyotp
+from urllib3.util.retry import Retry
+
+
+KITE_WEB_ROOT = "https://kite.zerodha.com"
+HTTP_TIMEOUT = 10  # seconds per login request
+MAX_REDIRECTS = 10  # Connect login -> finish -> app redirect URL is normally 2-3 hops
+# Saved access token per Zerodha user, so several accounts never pick up each other's token
+ACCESS_TOKEN_FILE_FMT = "access_token_{user_id}.txt"
+# request_token query parameter of the Connect redirect URL
+_RT_RE = re.compile(r"[?&]request_token=([^&#]+)")
+# Persistent Chrome profile for the browser fallback: warm cache and Kite session cookies across runs
+CHROME_PROFILE_DIR = Path.home() / ".cache" / "zerodha_chrome"
+# Zerodha user whose Kite session cookies the shared profile currently holds
+PROFILE_USER_FILE = CHROME_PROFILE_DIR / ".kite_user"
+# Kite access tokens are flushed every morning at 06:00 IST (fixed offset; IST has no DST)
+IST = timezone(timedelta(hours=5, minutes=30))
+TOKEN_RESET_TIME = dtime(6, 0)
+# A TOTP generated with less than this many seconds left is likely to expire before Kite checks it
+TOTP_MIN_VALIDITY = 2
+KITE_POOL_SIZE = 4  # keep-alive sockets per KiteConnect client (order polls, profile probe)
+# Browser fallback: one Chrome shared by every account, kept open between logins only on request
+_DRIVER: Optional[webdriver.Chrome] = None
+_DRIVER_LOCK = threading.Lock()
+# One client per (api_key, user_id) for the process, so repeated logins keep the same warm sockets
+# while each account keeps its own access token
+_KITE_CLIENTS: Dict[Tuple[str, Optional[str]], KiteConnect] = {}
+
+
+# Accepted title variants (lower-cased) per field in ZerodhaCredentials.csv; first non-empty wins
+ZERODHA_SCHEMA: Dict[str, Tuple[str, ...]] = {
+    "api_key": ("key", "api_key", "zerodhaapikey"),
+    "api_secret": ("secret", "api_secret", "zerodhaapisecret", "zerodhapisecret"),
+    "request_token": ("request_token",),
+    "user_id": ("id", "userid", "zerodhauserid"),
+    "password": ("pwd", "password", "zerodhapassword"),
+    "totp_secret": ("zerodha2fa", "2fa", "totp", "fa"),
+    "chromedriver_path": ("chromedriver", "chromedriver_path"),
+    "multiplier": ("copytradeqtymultiplier", "copy_trade_qty_multiplier", "multiplier"),
+}
+
+
+class ZerodhaCreds(NamedTuple):
+    api_key: Optional[str]
+    api_secret: Optional[str]
+    request_token: Optional[str]
+    user_id: Optional[str]
+    password: Optional[str]
+    totp_secret: Optional[str]
+    chromedriver_path: Optional[str]
+    multiplier: Optional[str]
+
+
+def read_csv_kv(csv_path: Path) -> Dict[str, str]:
+    out: Dict[str, str] = {}
+    if not csv_path.exists():
+        return out
+    # Plain two-column "title,value" file; everything after the first comma is the value
+    for raw in csv_path.read_text(encoding="utf-8").splitlines():
+        k, sep, v = raw.partition(",")
+        if not sep:
+            continue
+        k = k.strip().lower()
+        if k:
+            out[k] = v.strip()
+    return out
+
+
+def atomic_write(path: Path, data: bytes) -> None:
+    """Replace `path` with `data` so readers and crashes only ever see the old or the new file."""
+    # A temp file of its own per call: background writers of the same file never share one
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=path.name + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(data)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp)
+        raise
+
+
+def _write_in_background(path: Path, data: bytes) -> None:
+    """atomic_write off the login critical path; not a daemon, so interpreter exit waits for it."""
+    threading.Thread(target=atomic_write, args=(path, data), name=f"write-{path.name}").start()
+
+
+def http_pool(size: int) -> Dict[str, Any]:
+    """HTTPAdapter params for an SDK's `pool=` argument: `size` keep-alive sockets, 5xx retries.
+
+    Shared by the KiteConnect and XTSConnect clients. Retry's default allowed_methods
+    exclude POST, so order placement, quotes and the session exchange are never replayed.
+    """
+    retry = Retry(total=3, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504])
+    return {"pool_connections": size, "pool_maxsize": size, "max_retries": retry}
+
+
+def load_zerodha_creds(csv_path: Path) -> ZerodhaCreds:
+    """Parse ZerodhaCredentials.csv once and resolve each field from its accepted aliases."""
+    raw = read_csv_kv(csv_path)
+    return ZerodhaCreds(**{
+        name: next((raw[a] for a in aliases if raw.get(a)), None)
+        for name, aliases in ZERODHA_SCHEMA.items()
+    })
+
+
+def _request_token(url: str) -> Optional[str]:
+    m = _RT_RE.search(url)
+    return m.group(1) if m else None
+
+
+def _fresh_totp(totp_secret: str) -> str:
+    """Current TOTP code, waiting for the next window first if this one is about to roll over."""
+    totp = pyotp.TOTP(totp_secret)
+    remaining = totp.interval - time.time() % totp.interval
+    if remaining < TOTP_MIN_VALIDITY:
+        time.sleep(remaining + 0.2)
+    return totp.now()
+
+
+def _last_token_reset(now: datetime) -> datetime:
+    reset = datetime.combine(now.date(), TOKEN_RESET_TIME, tzinfo=IST)
+    return reset if now >= reset else reset - timedelta(days=1)
+
+
+def _access_token_file(user_id: str) -> Path:
+    return Path(ACCESS_TOKEN_FILE_FMT.format(user_id=user_id))
+
+
+def _cached_access_token(kite: KiteConnect, user_id: Optional[str]) -> Optional[str]:
+    """Reuse `user_id`'s saved token if it was saved after the last 06:00 IST reset and still works."""
+    if not user_id:
+        return None
+    token_file = _access_token_file(user_id)
+    try:
+        saved = datetime.fromtimestamp(token_file.stat().st_mtime, IST)
+        token = token_file.read_text(encoding="utf-8").strip()
+    except OSError:
+        return None
+    if not token or saved < _last_token_reset(datetime.now(IST)):
+        return None
+    kite.set_access_token(token)
+    try:
+        # Cheap authenticated call; fails with a TokenException once the token is revoked
+        profile = kite.profile()
+    except Exception:
+        return None
+    # A token that works but belongs to another account must not be handed out as this one's
+    if profile.get("user_id") != user_id:
+        return None
+    return token
 
 
 def login(
@@ -26,6 +186,7 @@ def login(
     totp_secret: Optional[str] = None,
     chromedriver_path: Optional[str] = None,
     headless: bool = True,
+    keep_browser: bool = False,
 ) -> Tuple[KiteConnect, str]:
     """
     Complete the Zerodha login by exchanging the request token for an access token.
@@ -36,265 +197,428 @@ def login(
       1) Direct user to `kite.login_url()` to obtain a request_token via redirect
       2) Call this function with the `request_token`
 
+    Without a request_token, a still-valid access_token_<user_id>.txt from today is reused;
+    otherwise user_id/password/totp_secret are used to log in over plain HTTPS,
+    falling back to a Selenium-driven browser if that fails. Pass `keep_browser=True`
+    when more logins (e.g. other accounts) follow, so they reuse the open browser.
+
     Raises an Exception with the underlying SDK error message if the exchange fails.
     """
     if not api_key or not api_secret:
         raise ValueError("api_key and api_secret are required")
 
-    kite = KiteConnect(api_key=api_key)
+    client_key = (api_key, user_id)
+    kite = _KITE_CLIENTS.get(client_key)
+    if kite is None:
+        kite = _KITE_CLIENTS[client_key] = KiteConnect(api_key=api_key, pool=http_pool(KITE_POOL_SIZE))
 
     # If a request_token is already available, use it directly
     if request_token:
         try:
-            print("[Zerodha] Using existing request_token. Exchanging for access_token in 2s...")
-            time.sleep(2)
+            print("[Zerodha] Using existing request_token. Exchanging for access_token...")
             session_data: Dict[str, str] = kite.generate_session(request_token, api_secret=api_secret)
             access_token: str = session_data["access_token"]
             kite.set_access_token(access_token)
-            print("[Zerodha] Access token set. Proceeding in 2s...")
-            time.sleep(2)
+            print("[Zerodha] Access token set.")
             return kite, access_token
         except Exception as exc:
             raise Exception(f"Zerodha login failed: {exc}") from exc
 
-    # Otherwise, attempt auto-login via Selenium using credentials and TOTP
+    access_token = _cached_access_token(kite, user_id)
+    if access_token:
+        print("[Zerodha] Reusing today's access token.")
+        return kite, access_token
+
+    # Otherwise, attempt auto-login using credentials and TOTP
     if not (user_id and password and totp_secret):
         raise ValueError(
             "request_token not provided. To auto-login, provide user_id, password, and totp_secret."
         )
 
-    # Setup headless Chrome (prefer Selenium Manager if no path provided)
+    # Plain HTTPS login first; the browser is only a fallback if Kite changes its endpoints
+    try:
+        req_token = _http_request_token(kite, user_id, password, totp_secret)
+        print("[Zerodha] Logged in over HTTP.")
+    except Exception as exc:
+        print(f"[Zerodha] HTTP login failed ({exc}); falling back to browser login...")
+        req_token = _selenium_request_token(kite, user_id, password, totp_secret, chromedriver_path, headless,
+                                            keep_browser)
+
+    # Save request_token
+    _write_in_background(Path("request_token.txt"), req_token.encode("utf-8"))
+
+    # Exchange request_token for access_token
+    try:
+        print("[Zerodha] Exchanging request_token for access_token...")
+        session_data: Dict[str, str] = kite.generate_session(req_token, api_secret=api_secret)
+        access_token: str = session_data["access_token"]
+        kite.set_access_token(access_token)
+
+        # Persist access token
+        _write_in_background(_access_token_file(user_id), access_token.encode("utf-8"))
+        print("[Zerodha] Access token set; saving it in the background.")
+
+        return kite, access_token
+    except Exception as exc:
+        raise Exception(f"Zerodha login (session exchange) failed: {exc}") from exc
+
+
+def _http_request_token(kite: KiteConnect, user_id: str, password: str, totp_secret: str) -> str:
+    """Log in through Kite's web endpoints (password, then TOTP) and return the request_token.
+
+    The Connect redirects are followed by hand: the last hop points at the app's redirect
+    URL, which need not be reachable from here, so the token is read from its Location.
+    """
+    with requests.Session() as session:
+        resp = session.post(
+            f"{KITE_WEB_ROOT}/api/login",
+            data={"user_id": user_id, "password": password},
+            timeout=HTTP_TIMEOUT,
+        )
+        body = resp.json()
+        if body.get("status") != "success":
+            raise Exception(f"password step failed: {body.get('message') or resp.status_code}")
+        request_id = body["data"]["request_id"]
+
+        resp = session.post(
+            f"{KITE_WEB_ROOT}/api/twofa",
+            data={
+                "user_id": user_id,
+                "request_id": request_id,
+                "twofa_value": _fresh_totp(totp_secret),
+                "twofa_type": "totp",
+            },
+            timeout=HTTP_TIMEOUT,
+        )
+        body = resp.json()
+        if body.get("status") != "success":
+            raise Exception(f"TOTP step failed: {body.get('message') or resp.status_code}")
+
+        url = kite.login_url()
+        for _ in range(MAX_REDIRECTS):
+            if _RT_RE.search(url):
+                break
+            resp = session.get(url, allow_redirects=False, timeout=HTTP_TIMEOUT)
+            location = resp.headers.get("Location")
+            if not location:
+                raise Exception(f"no redirect from {url} (HTTP {resp.status_code})")
+            url = urljoin(url, location)
+
+    req_token = _request_token(url)
+    if not req_token:
+        raise Exception("Failed to obtain request_token from the Connect redirects")
+    return req_token
+
+
+# Requests the browser login never needs (Chrome DevTools Network.setBlockedURLs patterns)
+BLOCKED_URL_PATTERNS = [
+    "*.woff", "*.woff2", "*.ttf", "*.png", "*.jpg", "*.jpeg", "*.gif", "*.svg",
+    "*google-analytics*", "*googletagmanager*", "*doubleclick*", "*facebook*",
+]
+# TOTP field locators, most reliable first (the 6-digit numeric field); none match the password box
+PIN_LOCATORS = [
+    (By.CSS_SELECTOR, 'input[type="number"][maxlength="6"]'),
+    (By.ID, 'pin'),
+    (By.CSS_SELECTOR, 'form input[type="number"]'),
+    (By.NAME, 'pin'),
+    (By.CSS_SELECTOR, "input[placeholder='••••••']"),
+]
+
+
+# Native value setter + input/change events, so the page's JS form state sees the typed value
+_SET_VALUE_JS = (
+    "const el = arguments[0];"
+    "Object.getOwnPropertyDescriptor(HTMLInputElement.prototype, 'value').set.call(el, arguments[1]);"
+    "el.dispatchEvent(new Event('input', {bubbles: true}));"
+    "el.dispatchEvent(new Event('change', {bubbles: true}));"
+)
+
+
+def _set_input_value(driver: webdriver.Chrome, el, value: str) -> None:
+    """Fill an input in one WebDriver command instead of one per keystroke."""
+    driver.execute_script(_SET_VALUE_JS, el, value)
+
+
+# Fill the TOTP and submit its form in one call. Split-box UIs (4+ visible password boxes) get one
+# digit per box. Returns false when there is no enclosing form to submit.
+_SUBMIT_TOTP_JS = """
+const el = arguments[0], code = arguments[1];
+const setValue = Object.getOwnPropertyDescriptor(HTMLInputElement.prototype, 'value').set;
+const fill = (input, v) => {
+    setValue.call(input, v);
+    input.dispatchEvent(new Event('input', {bubbles: true}));
+    input.dispatchEvent(new Event('change', {bubbles: true}));
+};
+el.scrollIntoView({block: 'center'});
+el.focus();
+const boxes = [...document.querySelectorAll('input[type="password"]')]
+    .filter(b => b.offsetParent !== null && !b.disabled);
+if (boxes.length >= 4) {
+    boxes.forEach((b, i) => fill(b, code[i] || ''));
+} else {
+    fill(el, code);
+}
+const form = el.closest('form');
+if (!form) return false;
+if (form.requestSubmit) form.requestSubmit(); else form.submit();
+return true;
+"""
+# Submit/continue buttons on the 2FA step, used when the form cannot be submitted directly
+CONTINUE_LOCATORS = [
+    (By.CSS_SELECTOR, 'button[type="submit"]'),
+    (By.CSS_SELECTOR, 'form button'),
+]
+
+
+def _submit_totp(driver: webdriver.Chrome, pin_el, token: str) -> None:
+    """Enter the TOTP and submit the 2FA step, in a single script call when the page allows it."""
     try:
-        options = Options()
-        if headless:
-            options.add_argument("--headless=new")
-        options.add_argument("--no-sandbox")
-        options.add_argument("--disable-dev-shm-usage")
-
-        # Create driver and open login page
-        if chromedriver_path:
-            service = Service(chromedriver_path)
-            driver = webdriver.Chrome(service=service, options=options)
-        else:
-            # Use Selenium Manager to auto-download/manage the correct driver
-            driver = webdriver.Chrome(options=options)
+        submitted = driver.execute_script(_SUBMIT_TOTP_JS, pin_el, token)
+    except Exception:
+        try:
+            pin_el.clear()
+        except Exception:
+            pass
+        pin_el.send_keys(token)
+        # ENTER already submits; clicking continue as well would send the code a second time
+        pin_el.send_keys(Keys.ENTER)
+        return
+    if submitted:
+        return
+    for by, sel in CONTINUE_LOCATORS:
         try:
-            print("[Zerodha] Opening login page. Waiting 2s...")
-            driver.get(kite.login_url())
-            time.sleep(2)
-            wait = WebDriverWait(driver, 30)
-
-            # Enter user id
-            try:
-                username_el = wait.until(EC.presence_of_element_located((By.ID, 'userid')))
-            except Exception:
-                username_el = wait.until(EC.presence_of_element_located((By.XPATH, '//*[@id="userid"]')))
-            username_el.send_keys(user_id)
-            print("[Zerodha] Entered user ID. Waiting 2s before entering password...")
-            time.sleep(2)
-
-            # Enter password
-            try:
-                password_el = driver.find_element(By.ID, 'password')
-            except Exception:
-                password_el = driver.find_element(By.XPATH, '//*[@id="password"]')
-            password_el.send_keys(password)
-            print("[Zerodha] Entered password. Waiting 2s before clicking login...")
-            time.sleep(2)
-
-            # Click login button
-            try:
-                login_btn = driver.find_element(By.CSS_SELECTOR, 'button[type="submit"]')
-            except Exception:
-                login_btn = driver.find_element(By.XPATH, '//*[@id="container"]/div/div/div[2]/form/div[4]/button')
-            login_btn.click()
-            print("[Zerodha] Clicked login. Waiting 2s for 2FA screen...")
-            time.sleep(2)
-
-            # Wait and enter TOTP/PIN - target numeric 6-digit field; avoid selecting the password field
-            pin_el = None
-            last_err = None
-            try:
-                # Most reliable: 6-digit numeric field
-                pin_el = WebDriverWait(driver, 20).until(
-                    EC.visibility_of_element_located((By.XPATH, "//input[@type='number' and @maxlength='6']"))
-                )
-            except Exception as e:
-                last_err = e
-                # exhaustive fallbacks (explicit 2FA container path first)
-                pin_locators = [
-                    (By.XPATH, '//*[@id="container"]/div[2]/div/div[2]/form/div[1]/input'),
-                    (By.XPATH, '/html/body/div[1]/div/div[2]/div[1]/div[2]/div/div[2]/form/div[1]/input'),
-                    (By.ID, 'pin'),
-                    (By.NAME, 'pin'),
-                    (By.CSS_SELECTOR, 'input#pin'),
-                    (By.CSS_SELECTOR, "input[placeholder='••••••']"),
-                ]
-                for by, sel in pin_locators:
-                    try:
-                        candidate = WebDriverWait(driver, 10).until(EC.visibility_of_element_located((by, sel)))
-                        # Avoid password field
-                        cid = (candidate.get_attribute('id') or '').lower()
-                        cname = (candidate.get_attribute('name') or '').lower()
-                        itype = (candidate.get_attribute('type') or '').lower()
-                        if cid == 'password' or cname == 'password':
-                            continue
-                        pin_el = candidate
-                        if pin_el:
-                            break
-                    except Exception as e2:
-                        last_err = e2
-                        continue
-            if pin_el is None:
-                try:
-                    driver.save_screenshot("zerodha_login_no_pin.png")
-                    Path("zerodha_login_no_pin.html").write_text(driver.page_source or "", encoding="utf-8")
-                except Exception:
-                    pass
-                raise Exception(f"Unable to locate TOTP/PIN field. Last error: {last_err}")
-            # Some UIs have 1 input; others split into 6 boxes. Handle both.
-            totp = pyotp.TOTP(totp_secret)
-            token = totp.now()
-            print("[Zerodha] Ready to enter TOTP. Waiting 2s so you can observe...")
-            time.sleep(2)
-            try:
-                # Try multiple inputs first
-                # Focus the element first (helps some numeric inputs)
-                try:
-                    driver.execute_script("arguments[0].scrollIntoView({block:'center'});", pin_el)
-                    pin_el.click()
-                except Exception:
-                    pass
-
-                otp_inputs = driver.find_elements(By.CSS_SELECTOR, 'input[type="password"]')
-                otp_inputs = [el for el in otp_inputs if el.is_displayed() and el.is_enabled()]
-                if len(otp_inputs) >= 4 and len(token) >= 4:
-                    for i, ch in enumerate(token[:len(otp_inputs)]):
-                        otp_inputs[i].clear()
-                        otp_inputs[i].send_keys(ch)
-                    # Press Enter on last box
-                    otp_inputs[min(len(otp_inputs)-1, len(token)-1)].send_keys(Keys.ENTER)
-                else:
-                    try:
-                        pin_el.clear()
-                    except Exception:
-                        pass
-                    pin_el.send_keys(token)
-                    pin_el.send_keys(Keys.ENTER)
-            except Exception:
-                try:
-                    pin_el.clear()
-                except Exception:
-                    pass
-                pin_el.send_keys(token)
-                pin_el.send_keys(Keys.ENTER)
-            print("[Zerodha] Entered TOTP. Waiting 2s before continuing...")
-            time.sleep(2)
-
-            # If there's a submit/continue button after PIN, click it
-            cont_locators = [
-                (By.XPATH, '//*[@id="container"]/div[2]/div/div[2]/form/div[2]/button'),  # explicit continue
-                (By.CSS_SELECTOR, 'button[type="submit"]'),
-                (By.XPATH, '//*[@id="container"]/div[2]/div/div[2]/form//button'),
-                (By.XPATH, '//form//button[@type="submit"]'),
-            ]
-            for by, sel in cont_locators:
-                try:
-                    cont_btn = driver.find_element(by, sel)
-                    cont_btn.click()
-                    break
-                except Exception:
-                    continue
-            print("[Zerodha] Clicked continue. Waiting 2s for redirect...")
-            time.sleep(2)
-
-            # Wait for redirect URL containing request_token (retry once if needed)
-            try:
-                wait.until(lambda d: "request_token=" in d.current_url)
-            except Exception:
-                # Retry once with a fresh TOTP in case the first expired
-                try:
-                    pin_el.clear()
-                except Exception:
-                    pass
-                # Re-locate pin field if needed (prefer numeric 6-digit field; avoid password)
-                try:
-                    pin_el = WebDriverWait(driver, 10).until(
-                        EC.visibility_of_element_located((By.XPATH, "//input[@type='number' and @maxlength='6']"))
-                    )
-                except Exception:
-                    try:
-                        pin_el = WebDriverWait(driver, 10).until(
-                            EC.visibility_of_element_located((By.XPATH, '//*[@id="container"]/div[2]/div/div[2]/form/div[1]/input'))
-                        )
-                    except Exception:
-                        try:
-                            pin_el = driver.find_element(By.ID, 'pin')
-                        except Exception:
-                            try:
-                                pin_el = driver.find_element(By.CSS_SELECTOR, "input[placeholder='••••••']")
-                            except Exception:
-                                pin_el = driver.find_element(By.XPATH, "//input[@type='password']")
-                token = pyotp.TOTP(totp_secret).now()
-                try:
-                    driver.execute_script("arguments[0].scrollIntoView({block:'center'});", pin_el)
-                    pin_el.click()
-                except Exception:
-                    pass
-                pin_el.send_keys(token)
-                for by, sel in cont_locators:
-                    try:
-                        cont_btn = driver.find_element(by, sel)
-                        cont_btn.click()
-                        break
-                    except Exception:
-                        continue
-                wait.until(lambda d: "request_token=" in d.current_url)
-                print("[Zerodha] Retried TOTP. Waiting 2s for redirect...")
-                time.sleep(2)
-
-            url = driver.current_url
-            parsed_url = urlparse(url)
-            query_params = parse_qs(parsed_url.query)
-            req_token = (query_params.get("request_token") or [None])[0]
-            if not req_token:
-                # Persist debug artifacts for diagnosis
-                try:
-                    driver.save_screenshot("zerodha_login_debug.png")
-                    Path("zerodha_login_debug.html").write_text(driver.page_source or "", encoding="utf-8")
-                except Exception:
-                    pass
-                raise Exception("Failed to obtain request_token from redirected URL")
-
-            # Save request_token
-            Path("request_token.txt").write_text(req_token, encoding="utf-8")
-            print("[Zerodha] Captured request_token. Waiting 2s before closing browser...")
-            time.sleep(2)
+            _js_click(driver, driver.find_element(by, sel))
+            break
+        except Exception:
+            continue
 
-        finally:
-            try:
-                driver.quit()
-            except Exception:
-                pass
 
-        # Exchange request_token for access_token
+def _js_click(driver: webdriver.Chrome, el) -> None:
+    """Click with one synthesized DOM click; native click (actionability checks) only if that fails."""
+    try:
+        driver.execute_script("arguments[0].click();", el)
+    except Exception:
+        el.click()
+
+
+def _chrome_options(profile_dir: Path, headless: bool) -> Options:
+    options = Options()
+    if headless:
+        options.add_argument("--headless=new")
+    options.add_argument("--no-sandbox")
+    options.add_argument("--disable-dev-shm-usage")
+    profile_dir.mkdir(parents=True, exist_ok=True)
+    options.add_argument(f"--user-data-dir={profile_dir}")
+    options.add_argument("--profile-directory=Default")
+    options.add_argument("--disable-gpu")
+    options.add_argument("--disable-extensions")
+    # The login page needs no images; skip fetching and decoding them
+    options.add_argument("--blink-settings=imagesEnabled=false")
+    # Background subsystems a one-shot form fill never uses
+    options.add_argument("--disable-background-networking")
+    options.add_argument("--disable-sync")
+    options.add_argument("--disable-translate")
+    options.add_argument("--disable-default-apps")
+    options.add_argument("--no-first-run")
+    options.add_argument("--disable-features=TranslateUI,MediaRouter")
+    options.add_experimental_option("prefs", {
+        "profile.managed_default_content_settings.images": 2,
+        "profile.default_content_setting_values.notifications": 2,
+    })
+    # driver.get() returns at DOMContentLoaded; every step below waits explicitly for its element
+    options.page_load_strategy = "eager"
+    return options
+
+
+def _get_or_create_driver(chromedriver_path: Optional[str], headless: bool) -> webdriver.Chrome:
+    """Return the shared browser, already switched to a fresh tab; starts Chrome on first use.
+
+    A running browser keeps whatever headless mode it was started with.
+    """
+    global _DRIVER
+    if _DRIVER is not None:
         try:
-            print("[Zerodha] Exchanging request_token for access_token in 2s...")
-            time.sleep(2)
-            session_data: Dict[str, str] = kite.generate_session(req_token, api_secret=api_secret)
-            access_token: str = session_data["access_token"]
-            kite.set_access_token(access_token)
+            _DRIVER.switch_to.new_window("tab")
+            return _DRIVER
+        except Exception:
+            # Browser was closed or crashed since the last login
+            _quit_driver()
+
+    options = _chrome_options(CHROME_PROFILE_DIR, headless)
+    # Prefer Selenium Manager if no chromedriver path is provided
+    if chromedriver_path:
+        service = Service(chromedriver_path)
+        driver = webdriver.Chrome(service=service, options=options)
+    else:
+        # Use Selenium Manager to auto-download/manage the correct driver
+        driver = webdriver.Chrome(options=options)
+    _DRIVER = driver
+    # Log in on a second tab; the first one keeps the browser alive when that tab is closed
+    driver.switch_to.new_window("tab")
+    return driver
+
+
+def _release_tab(driver: webdriver.Chrome) -> None:
+    try:
+        driver.close()
+        driver.switch_to.window(driver.window_handles[0])
+    except Exception:
+        pass
 
-            # Persist access token
-            Path("access_token.txt").write_text(access_token, encoding="utf-8")
-            print("[Zerodha] Access token saved. Waiting 2s before returning...")
-            time.sleep(2)
 
-            return kite, access_token
-        except Exception as exc:
-            raise Exception(f"Zerodha login (session exchange) failed: {exc}") from exc
-    finally:
+def _quit_driver() -> None:
+    global _DRIVER
+    if _DRIVER is not None:
+        try:
+            _DRIVER.quit()
+        except Exception:
+            pass
+        _DRIVER = None
+
+
+atexit.register(_quit_driver)
+
+
+def _switch_profile_user(driver: webdriver.Chrome, user_id: str) -> None:
+    """Drop another account's Kite session cookies before logging `user_id` in.
+
+    The profile (and its cookies) is shared by every account, so a session left by a
+    different user would otherwise answer this login. Same user: cookies are kept.
+    """
+    try:
+        last_user = PROFILE_USER_FILE.read_text(encoding="utf-8").strip()
+    except OSError:
+        last_user = ""
+    if last_user != user_id:
+        driver.execute_cdp_cmd("Network.clearBrowserCookies", {})
+        atomic_write(PROFILE_USER_FILE, user_id.encode("utf-8"))
+
+
+def _selenium_request_token(
+    kite: KiteConnect,
+    user_id: str,
+    password: str,
+    totp_secret: str,
+    chromedriver_path: Optional[str],
+    headless: bool,
+    keep_browser: bool = False,
+) -> str:
+    """Drive the Kite login page in Chrome and return the request_token from the redirect.
+
+    The browser is quit afterwards unless `keep_browser`, in which case only the login tab
+    is closed and the next login (for any account) reuses the running Chrome.
+    """
+    # One WebDriver session is not safe to drive from two threads, so logins take turns
+    with _DRIVER_LOCK:
+        driver = _get_or_create_driver(chromedriver_path, headless)
+        try:
+            _switch_profile_user(driver, user_id)
+            return _browser_login(driver, kite, user_id, password, totp_secret)
+        finally:
+            if keep_browser:
+                _release_tab(driver)
+            else:
+                _quit_driver()
+
+
+def _browser_login(driver: webdriver.Chrome, kite: KiteConnect, user_id: str, password: str, totp_secret: str) -> str:
+    """Fill the Kite login form in the driver's current tab and return the request_token."""
+    # Fonts, images and trackers play no part in the login form; don't fetch them at all
+    try:
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": BLOCKED_URL_PATTERNS})
+    except Exception as exc:
+        print(f"[Zerodha] Could not block page assets ({exc}); continuing.")
+
+    # Each step waits for the element it needs next instead of sleeping a fixed time
+    print("[Zerodha] Opening login page...")
+    driver.get(kite.login_url())
+    wait = WebDriverWait(driver, 30)
+    # A Kite session cookie kept in the profile can redirect straight to the app; with eager
+    # loading that redirect may still be in flight, so wait for it or the login form
+    try:
+        wait.until(EC.any_of(EC.url_contains("request_token="), EC.presence_of_element_located((By.ID, 'userid'))))
+    except Exception:
         pass
+    req_token = _request_token(driver.current_url)
+    if req_token:
+        print("[Zerodha] Browser session still active; captured request_token.")
+        return req_token
+
+    # Enter user id
+    try:
+        username_el = wait.until(EC.presence_of_element_located((By.ID, 'userid')))
+    except Exception:
+        username_el = wait.until(EC.presence_of_element_located((By.CSS_SELECTOR, 'input#userid')))
+    _set_input_value(driver, username_el, user_id)
+    print("[Zerodha] Entered user ID.")
+
+    # Enter password
+    try:
+        password_el = wait.until(EC.element_to_be_clickable((By.ID, 'password')))
+    except Exception:
+        password_el = driver.find_element(By.CSS_SELECTOR, 'input#password')
+    _set_input_value(driver, password_el, password)
+    print("[Zerodha] Entered password.")
+
+    # Click login button
+    try:
+        login_btn = wait.until(EC.element_to_be_clickable((By.CSS_SELECTOR, 'button[type="submit"]')))
+    except Exception:
+        login_btn = driver.find_element(By.CSS_SELECTOR, 'form button')
+    _js_click(driver, login_btn)
+    print("[Zerodha] Clicked login. Waiting for 2FA screen...")
+
+    # Wait and enter TOTP/PIN - target numeric 6-digit field; avoid selecting the password field
+    pin_el = None
+    last_err = None
+    try:
+        # any_of polls every locator together, so a miss costs one timeout rather than one per locator
+        pin_el = WebDriverWait(driver, 20).until(
+            EC.any_of(*(EC.visibility_of_element_located(loc) for loc in PIN_LOCATORS))
+        )
+    except Exception as e:
+        last_err = e
+    if pin_el is None:
+        try:
+            driver.save_screenshot("zerodha_login_no_pin.png")
+            Path("zerodha_login_no_pin.html").write_text(driver.page_source or "", encoding="utf-8")
+        except Exception:
+            pass
+        raise Exception(f"Unable to locate TOTP/PIN field. Last error: {last_err}")
+    _submit_totp(driver, pin_el, _fresh_totp(totp_secret))
+    print("[Zerodha] Entered TOTP. Waiting for redirect...")
+
+    # Wait for redirect URL containing request_token (retry once if needed)
+    try:
+        wait.until(EC.url_contains("request_token="))
+    except Exception:
+        # Retry once with a fresh TOTP in case the first expired
+        try:
+            pin_el.clear()
+        except Exception:
+            pass
+        # Re-locate pin field; a plain password-type box is accepted only as a last resort
+        pin_el = WebDriverWait(driver, 10).until(EC.any_of(
+            *(EC.visibility_of_element_located(loc) for loc in PIN_LOCATORS),
+            EC.visibility_of_element_located((By.CSS_SELECTOR, 'input[type="password"]')),
+        ))
+        _submit_totp(driver, pin_el, _fresh_totp(totp_secret))
+        wait.until(EC.url_contains("request_token="))
+        print("[Zerodha] Retried TOTP.")
+
+    req_token = _request_token(driver.current_url)
+    if not req_token:
+        # Persist debug artifacts for diagnosis
+        try:
+            driver.save_screenshot("zerodha_login_debug.png")
+            Path("zerodha_login_debug.html").write_text(driver.page_source or "", encoding="utf-8")
+        except Exception:
+            pass
+        raise Exception("Failed to obtain request_token from redirected URL")
+
+    print("[Zerodha] Captured request_token.")
+    return req_token
 
 
 def fetch_completed_orders(kite: KiteConnect) -> List[Dict]:
@@ -303,6 +627,9 @@ def fetch_completed_orders(kite: KiteConnect) -> List[Dict]:
 
     The Zerodha API uses status value 'COMPLETE' for fully executed orders.
     Returns a list of order dictionaries as provided by the SDK.
+
+    Pass the client returned by `login()` rather than a new KiteConnect, so its
+    pooled keep-alive connection is reused across fetches.
     """
     if kite is None:
         raise ValueError("kite client is required")
@@ -312,7 +639,6 @@ def fetch_completed_orders(kite: KiteConnect) -> List[Dict]:
     except Exception as exc:
         raise Exception(f"Failed to fetch orders: {exc}") from exc
 
-    completed = [order for order in all_orders if str(order.get("status", "")).upper() == "COMPLETE"]
-    return completed
+    return [order for order in all_orders if order.get("status") == "COMPLETE"]
 
 